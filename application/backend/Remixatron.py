@@ -32,17 +32,31 @@ be signaled when the processing is complete. The default mode is to run synchron
 """
 
 import collections
+import concurrent.futures
+import joblib
 import librosa
 import madmom
 import math
+import os
 import random
 import scipy
+import scipy.sparse.linalg
 import threading
 
 import numpy as np
+import sklearn
 import sklearn.cluster
 import sklearn.metrics
 
+try:
+    import cuml
+    import cuml.cluster
+    import cuml.metrics.cluster
+    import cupy
+except ImportError:
+    cuml = None
+    cupy = None
+
 
 def symmetrize_matrix(matrix):
     """
@@ -59,25 +73,11 @@ def symmetrize_matrix(matrix):
     if matrix.shape[0] != matrix.shape[1]:
         raise ValueError(f"Matrix is not square: shape is {matrix.shape}")
         
-    try:
-        # Create a copy to avoid modifying the original
-        matrix_symm = matrix.copy()
+    # Average the matrix with its transpose in two vectorized passes
+    matrix_symm = np.add(matrix, matrix.T, out=np.empty_like(matrix))
+    matrix_symm *= 0.5
 
-      # Get the indices of the upper triangle (excluding diagonal)
-        i_upper = np.triu_indices_from(matrix_symm, k=1)
-        
-        # Calculate the average of corresponding elements
-        avg_values = 0.5 * (matrix_symm[i_upper] + matrix_symm[i_upper[1], i_upper[0]])
-        
-        # Set both upper and lower triangular elements to the average
-        matrix_symm[i_upper] = avg_values
-        matrix_symm[i_upper[1], i_upper[0]] = avg_values
- 
-        return matrix_symm
-    except Exception as e:
-        print(f"Error in symmetrize_matrix: {e}")
-        # Return the original matrix if symmetrization fails
-        return matrix
+    return matrix_symm
 
 
 def check_matrix(matrix):
@@ -101,6 +101,145 @@ def check_matrix(matrix):
                 return
 
 
+# MiB of pairwise distances each silhouette score computation may hold at a time
+SILHOUETTE_WORKING_MEMORY = 256
+
+
+def _segment_stats_from_labels(labels):
+    """
+    Computes the segment/cluster ratio and whether any segment is a single beat
+    long (an orphan) given an array of labels.
+    """
+
+    labels = np.asarray(labels)
+
+    # the index of the first beat of every segment after the first one
+    boundaries = np.flatnonzero(labels[1:] != labels[:-1]) + 1
+
+    segment_count = boundaries.size + 1
+    clusters = labels.max() + 1
+
+    # lengths of every segment but the last (which is still open when the labels run out)
+    segment_lengths = np.diff(boundaries, prepend=0)
+
+    return float(segment_count) / float(clusters), bool((segment_lengths == 1).any())
+
+
+def _fit_and_score(n_clusters, X, D, random_state=0):
+    """
+    Clusters the beats into n_clusters groups and grades the result.
+
+    Module level so joblib can run one candidate cluster count per worker
+    for InfiniteJukebox.__compute_best_cluster_with_sil.
+
+    Args:
+        n_clusters: The candidate cluster count
+        X: The first n_clusters normalized Eigen-vectors, one row per beat
+        D: Pairwise distances between the beats, shared by every candidate
+        random_state: Seed for KMeans, fixed so results don't depend on scheduling
+
+    Returns:
+        (n_clusters, cluster_labels, cluster_score)
+    """
+
+    # create the candidate clusters and fit them. This is only a screening pass over
+    # the candidate counts, so a few randomly seeded runs are good enough to rank them;
+    # the winner is refit with k-means++ and more restarts afterwards.
+    clusterer = sklearn.cluster.KMeans(n_clusters=n_clusters, init='random', n_init=3,
+                                       max_iter=100, algorithm='lloyd', random_state=random_state)
+
+    cluster_labels = clusterer.fit_predict(X)
+
+    # silhouette_score works through the pairwise distances in blocks of at most
+    # working_memory MiB; keep that small since several of these run at once
+    with sklearn.config_context(working_memory=SILHOUETTE_WORKING_MEMORY):
+        silhouette_avg = sklearn.metrics.silhouette_score(D, cluster_labels, metric='precomputed')
+
+    return (n_clusters, cluster_labels, _grade_clusters(n_clusters, cluster_labels, silhouette_avg))
+
+
+def _fit_and_score_gpu(n_clusters, X, X_all, random_state=0):
+    """
+    GPU counterpart of _fit_and_score, built on cuML.
+
+    Args:
+        n_clusters: The candidate cluster count
+        X: The first n_clusters normalized Eigen-vectors, one row per beat, as a cupy array
+        X_all: The normalized Eigen-vectors the silhouette distances are measured in, as a cupy array
+        random_state: Seed for KMeans
+
+    Returns:
+        (n_clusters, cluster_labels, cluster_score), with cluster_labels back on the host
+    """
+
+    clusterer = cuml.cluster.KMeans(n_clusters=n_clusters, init='random', n_init=3,
+                                    max_iter=100, random_state=random_state)
+
+    labels_gpu = clusterer.fit_predict(X)
+
+    # cuML computes the silhouette in batches on the device, so the N x N distance
+    # matrix is never materialized
+    silhouette_avg = float(cuml.metrics.cluster.silhouette_score(X_all, labels_gpu))
+
+    cluster_labels = cupy.asnumpy(labels_gpu)
+
+    return (n_clusters, cluster_labels, _grade_clusters(n_clusters, cluster_labels, silhouette_avg))
+
+
+def _grade_clusters(n_clusters, cluster_labels, silhouette_avg):
+    """
+    Computes the fitness score of one candidate cluster count.
+
+    Args:
+        n_clusters: The candidate cluster count
+        cluster_labels: The cluster of each beat
+        silhouette_avg: The average silhouette score of cluster_labels
+
+    Returns:
+        The candidate's cluster_score; higher is better
+    """
+
+    # get the other key statistics: the ratio of segments to clusters, and whether
+    # any segment in this cluster configuration is only one beat long
+
+    ratio, has_orphan = _segment_stats_from_labels(cluster_labels)
+
+    # We need to grade each cluster according to how likely it is to produce a good
+    # result. There are a few factors to look at.
+    #
+    # First, we can look at how similar the beats in each cluster (on average) are for
+    # this candidate cluster size. This is known as the silhouette score. It ranges
+    # from -1 (very bad) to 1 (very good).
+    #
+    # Another thing we can look at is the ratio of clusters to segments. Higher ratios
+    # are preferred because they afford each beat in a cluster the opportunity to jump
+    # around to meaningful places in the song.
+    #
+    # All other things being equal, we prefer a higher cluster count to a lower one
+    # because it will tend to make the jumps more selective -- and therefore higher
+    # quality.
+    #
+    # Lastly, if we see that we have segments equal to just one beat, that might be
+    # a sign of overfitting. We call these one beat segments 'orphans'. Some songs,
+    # however, will have orphans no matter what cluster count you use. So, we don't
+    # want to throw out a cluster count just because it has orphans. Instead, we
+    # just de-rate its fitness score. If most of the cluster candidates have orphans
+    # then this won't matter in the overall scheme because everyone will be de-rated
+    # by the same scaler.
+    #
+    # Putting this all together, we muliply the cluster count * the average
+    # silhouette score for the clusters in this candidate * the ratio of clusters to
+    # segments. Then we scale (or de-rate) the fitness score by whether or not is has
+    # orphans in it.
+
+    orphan_scaler = .8 if has_orphan else 1
+
+    cluster_score = n_clusters * silhouette_avg * ratio * orphan_scaler
+    #cluster_score = ((n_clusters/48.0) * silhouette_avg * (ratio/10.0)) * orphan_scaler
+
+    return cluster_score
+
+
 class InfiniteJukebox(object):
 
     """ Class to "infinitely" remix a song.
@@ -183,6 +322,16 @@ class InfiniteJukebox(object):
 
     """
 
+    # the largest cluster counts tried by the silhouette and v1 auto-clustering searches
+    MAX_SIL_CLUSTERS = 48
+    MAX_V1_CLUSTERS = 62
+
+    # songs with at least this many beats whose affinity matrix is at most this dense
+    # (ignoring entries below SPARSE_AFFINITY_EPS) use the sparse eigensolver
+    SPARSE_EIGEN_MIN_BEATS = 1500
+    SPARSE_EIGEN_MAX_DENSITY = 0.1
+    SPARSE_AFFINITY_EPS = 1e-4
+
     def __init__(self, filename, start_beat=1, clusters=0, progress_callback=None,
                  do_async=False, use_v1=False, starting_beat_cache=None):
 
@@ -256,9 +405,11 @@ class InfiniteJukebox(object):
         self.sample_rate = sr
 
         # after the raw audio bytes are saved, convert the samples to mono
-        # because the beat detection algorithm in librosa requires it.
+        # because the beat detection algorithm in librosa requires it. Rebinding
+        # y releases the stereo samples as soon as the mix-down is done.
 
-        y = librosa.core.to_mono(y)
+        if y.ndim == 2:
+            y = np.mean(y, axis=0, dtype=np.float32)
 
         self.__report_progress( .2, "computing pitch data..." )
 
@@ -267,8 +418,22 @@ class InfiniteJukebox(object):
         BINS_PER_OCTAVE = 12 * 3
         N_OCTAVES = 7
 
-        cqt = librosa.cqt(y=y, sr=sr, bins_per_octave=BINS_PER_OCTAVE, n_bins=N_OCTAVES * BINS_PER_OCTAVE)
-        C = librosa.amplitude_to_db( np.abs(cqt), ref=np.max)
+        # The CQT, the log-power mel spectrogram (for the MFCCs) and the RMS envelope only
+        # depend on y, so compute them on worker threads while the beat finding below
+        # runs. librosa spends most of that time in numpy/FFT code that
+        # releases the GIL. Each result is collected where it is first needed.
+
+        feature_pool = concurrent.futures.ThreadPoolExecutor(max_workers=3)
+
+        cqt_future = feature_pool.submit(librosa.cqt, y=y, sr=sr, bins_per_octave=BINS_PER_OCTAVE,
+                                         n_bins=N_OCTAVES * BINS_PER_OCTAVE)
+        log_mel_future = feature_pool.submit(lambda: librosa.power_to_db(librosa.feature.melspectrogram(y=y, sr=sr)))
+
+        # newer versions of librosa have renamed the rmse function
+        rms_future = feature_pool.submit(librosa.feature.rms if hasattr(librosa.feature, 'rms') else librosa.feature.rmse,
+                                         y=y)
+
+        feature_pool.shutdown(wait=False)
 
         ##########################################################
         # To reduce dimensionality, we'll beat-synchronous the CQT
@@ -287,9 +452,13 @@ class InfiniteJukebox(object):
             self.__report_progress( .3, "Running a high precision beat finding algorithm. This could take up to 2 minutes..." )
     
             try:
-                # Try using madmom for beat detection
-                proc = madmom.features.DBNDownBeatTrackingProcessor(beats_per_bar=[3, 4], fps=100)
-                act = madmom.features.RNNDownBeatProcessor()(y)
+                # Try using madmom for beat detection. Both of its processors can fan out
+                # over several threads; MADMOM_THREADS overrides the default of one per core.
+                madmom_threads = int(os.environ.get('MADMOM_THREADS', os.cpu_count() or 1))
+
+                proc = madmom.features.DBNDownBeatTrackingProcessor(beats_per_bar=[3, 4], fps=100,
+                                                                    num_threads=madmom_threads)
+                act = self.__downbeat_activations(y, sr, madmom_threads)
                 downbeats = proc(act)
                 
                 # Check if downbeats were detected
@@ -328,11 +497,21 @@ class InfiniteJukebox(object):
 
         ### END MADMOM
 
+        C = librosa.amplitude_to_db( np.abs(cqt_future.result()), ref=np.max)
+
         # tempo, btz = librosa.beat.beat_track(y=y, sr=sr)
         Csync = librosa.util.sync(C, btz, aggregate=np.median)
 
+        # the beat times already pin down the tempo: every row of downbeats is a beat,
+        # so the median gap between them is the beat period. Only estimate it from the
+        # onset envelope if there are too few beats for that.
+
         # self.tempo = tempo[0]
-        self.tempo = librosa.feature.tempo(y=y, sr=sr)[0]
+        if len(downbeats) > 1:
+            self.tempo = float(60.0 / np.median(np.diff(downbeats[:, 0])))
+        else:
+            self.tempo = librosa.feature.tempo(onset_envelope=librosa.onset.onset_strength(S=log_mel_future.result(), sr=sr),
+                                               sr=sr)[0]
 
         # For alignment purposes, we'll need the timing of the beats
         # we fix_frames to include non-beat frames 0 and C.shape[1] (final frame)
@@ -357,9 +536,6 @@ class InfiniteJukebox(object):
             
             # ensure real eigenvectors from Laplacian by forcing Rf back into symmetry
             Rf = symmetrize_matrix(R_smoothed)
-
-            print("Rf has been symmetrized. Now check matrix Rf...")
-            check_matrix(Rf)
         except Exception as e:
             raise ValueError(f"Error in recurrence matrix calculation: {e}")
             
@@ -373,63 +549,47 @@ class InfiniteJukebox(object):
         #
         # Here, we take :math:`\sigma` to be the median distance between successive beats.
         #
-        mfcc = librosa.feature.mfcc(y=y, sr=sr)
+        mfcc = librosa.feature.mfcc(S=log_mel_future.result(), sr=sr)
         Msync = librosa.util.sync(mfcc, btz)
 
         path_distance = np.sum(np.diff(Msync, axis=1)**2, axis=0)
         sigma = np.median(path_distance)
         path_sim = np.exp(-path_distance / sigma)
 
-        R_path = np.diag(path_sim, k=1) + np.diag(path_sim, k=-1)
+        # R_path = np.diag(path_sim, k=1) + np.diag(path_sim, k=-1) only has its first
+        # off-diagonals set, so work from path_sim rather than building it densely
 
+        path_idx = np.arange(len(path_sim))
 
         ##########################################################
         # And compute the balanced combination (Equations 6, 7, 9)
 
-        check_matrix(Rf)
-        check_matrix(R_path)
-
-        deg_path = np.sum(R_path, axis=1)
+        deg_path = np.zeros(len(path_sim) + 1, dtype=path_sim.dtype)
+        deg_path[:-1] += path_sim
+        deg_path[1:] += path_sim
         deg_rec = np.sum(Rf, axis=1)
 
         mu = deg_path.dot(deg_path + deg_rec) / np.sum((deg_path + deg_rec)**2)
 
-        A = mu * Rf + (1 - mu) * R_path
-
-        check_matrix(A)
+        # A = mu * Rf + (1 - mu) * R_path, built in place over Rf
+        A = Rf
+        A *= mu
+        A[path_idx, path_idx + 1] += (1 - mu) * path_sim
+        A[path_idx + 1, path_idx] += (1 - mu) * path_sim
 
         #####################################################
-        # Now let's compute the normalized Laplacian (Eq. 10)
-        L_orig = scipy.sparse.csgraph.laplacian(A, normed=True)
-        # make sure L is contiguous
-        L = np.ascontiguousarray(L_orig)
+        # Now let's compute the normalized Laplacian (Eq. 10) and its spectral decomposition.
+        print("Calc eigenvectors for Hermitian Laplacian")
 
-        # ### HACK: ensure L is contiguous to avoid seg fault with eig()
-        # # Save matrix L to disk
-        # np.save('laplacian_matrix.npy', L_orig)
-        # # Load matrix L back from disk
-        # L = np.load('laplacian_matrix.npy')
-
-        # # Verify that the loaded matrix is the same as the original
-        # if np.array_equal(L, L_orig):
-        #     print("Matrix L successfully saved and loaded.")
-        # else:
-        #     print("Warning: Loaded matrix L does not match the original.")
-
-        # ### END Hack
-
-        check_matrix(L)
-
-        # to use eigh(), matrix should be symmetrix and hermitian
-        is_hermitian = np.allclose(L, L.T.conj())
-
-        # and its spectral decomposition
-        if is_hermitian:
-            print("Calc eigenvectors for Hermitian Laplacian")
-            _, evecs = scipy.linalg.eigh(L)
+        # clustering only ever looks at the first k eigenvectors, so only ask
+        # for as many as the largest k we are going to try
+        if self.clusters > 0:
+            n_evecs = self.clusters
         else:
-            raise ValueError("Matrix L is not Hermitian. Cannot compute eigenvectors using scipy.linalg.eigh.")
-            return
+            n_evecs = self.MAX_V1_CLUSTERS if self._use_v1 else self.MAX_SIL_CLUSTERS
+        n_evecs = min(n_evecs, A.shape[0])
+
+        evecs = self.__laplacian_eigenvectors(A, n_evecs)
 
         # We can clean this up further with a median filter.
         # This can help smooth over small discontinuities
@@ -461,45 +621,46 @@ class InfiniteJukebox(object):
 
             self.__report_progress( .51, "using %d clusters" % self.clusters )
 
-            X = evecs[:, :k] / Cnorm[:, k-1:k]
-            seg_ids = sklearn.cluster.KMeans(n_clusters=k, max_iter=1000,
-                                             random_state=0, n_init=1000).fit_predict(X)
+            X = self.__cluster_features(evecs, 1.0 / Cnorm, k)
+            seg_ids = sklearn.cluster.KMeans(n_clusters=k, init='k-means++', max_iter=300,
+                                             random_state=0, n_init=10, copy_x=False).fit_predict(X)
 
         # Get the amplitudes and beat-align them
         self.__report_progress( .6, "getting amplitudes" )
 
-        # newer versions of librosa have renamed the rmse function
-
-        if hasattr(librosa.feature,'rms'):
-            amplitudes = librosa.feature.rms(y=y)
-        else:
-            amplitudes = librosa.feature.rmse(y=y)
+        amplitudes = rms_future.result()
 
         ampSync = librosa.util.sync(amplitudes, btz)
 
-        # create a list of tuples that include the ordinal position, the start time of the beat,
-        # the cluster to which the beat belongs and the mean amplitude of the beat
+        # line up, per beat, the start time of the beat, the cluster to which the beat
+        # belongs and the mean amplitude of the beat
 
-        zbeat_tuples = zip(range(0,len(btz)), beat_times, seg_ids, ampSync[0].tolist())
-        beat_tuples =tuple(zbeat_tuples)
+        num_beats = min(len(btz), len(beat_times), len(seg_ids), ampSync.shape[1])
+
+        starts = np.asarray(beat_times[:num_beats], dtype=np.float64)
+        clusters = np.asarray(seg_ids[:num_beats]).tolist()
+        beat_amplitudes = ampSync[0, :num_beats].tolist()
 
         info = []
 
         bytes_per_second = int(round(len(self.raw_audio) / self.duration))
 
+        # A beat lasts until the next one starts; the last one runs to the end of the track
+        durations = np.diff(np.append(starts, self.duration)).tolist()
+
         last_cluster = -1
         current_segment = -1
         segment_beat = 0
 
-        # Iterate over each beat tuple to process and extract relevant information
-        for i in range(0, len(beat_tuples)):
+        # Iterate over each beat to process and extract relevant information
+        for i in range(0, num_beats):
             final_beat = {}
             # Extract the start time of the beat
-            final_beat['start'] = float(beat_tuples[i][1])
+            final_beat['start'] = float(starts[i])
             # Extract the cluster ID to which the beat belongs
-            final_beat['cluster'] = int(beat_tuples[i][2])
+            final_beat['cluster'] = int(clusters[i])
             # Extract the amplitude of the beat
-            final_beat['amplitude'] = float(beat_tuples[i][3])
+            final_beat['amplitude'] = float(beat_amplitudes[i])
 
             # Check if the current beat belongs to a new cluster
             if final_beat['cluster'] != last_cluster:
@@ -517,13 +678,8 @@ class InfiniteJukebox(object):
             # Update the last cluster to the current beat's cluster
             last_cluster = final_beat['cluster']
 
-            # Calculate the duration of the beat
-            if i == len(beat_tuples) - 1:
-                # If it's the last beat, the duration is the remaining time of the audio
-                final_beat['duration'] = self.duration - final_beat['start']
-            else:
-                # Otherwise, the duration is the difference between the start times of consecutive beats
-                final_beat['duration'] = beat_tuples[i+1][1] - beat_tuples[i][1]
+            # Look up the duration of the beat
+            final_beat['duration'] = durations[i]
 
             # # Calculate the start index in the raw audio buffer
             # if ( (final_beat['start'] * bytes_per_second) % 2 > 1.5 ):
@@ -544,7 +700,8 @@ class InfiniteJukebox(object):
 
         # get the max amplitude of the beats
         # max_amplitude = max([float(b['amplitude']) for b in info])
-        max_amplitude = sum([float(b['amplitude']) for b in info]) / len(info)
+        amps = np.fromiter((b['amplitude'] for b in info), dtype=np.float64, count=len(info))
+        max_amplitude = float(amps.mean())
 
         # assume that the fade point of the song is the last beat of the song that is >= 75% of
         # the max amplitude.
@@ -553,10 +710,10 @@ class InfiniteJukebox(object):
 
         fade = len(info) - 1
 
-        for b in reversed(info):
-            if b['amplitude'] >= (.75 * max_amplitude):
-                fade = info.index(b)
-                break
+        loud = np.flatnonzero(amps >= (.75 * max_amplitude))
+
+        if loud.size:
+            fade = int(loud[-1])
 
         # don't need the entire song, since it gets repetitive
         beats = info[self.__start_beat:fade + 1]
@@ -568,15 +725,25 @@ class InfiniteJukebox(object):
         self.__report_progress( .8, "computing final beat array..." )
 
         # assign final beat ids
-        for beat in beats:
-            beat['id'] = beats.index(beat)
-            beat['quartile'] = beat['id'] // (len(beats) / 4.0)
+        for idx, beat in enumerate(beats):
+            beat['id'] = idx
+            beat['quartile'] = idx // (len(beats) / 4.0)
+
+        # per-beat attributes as flat arrays so jump candidates can be found with
+        # boolean masks instead of rescanning the beat dicts for every beat.
+
+        cluster_np = np.fromiter((b['cluster'] for b in beats), dtype=np.int32, count=len(beats))
+        is_np = np.fromiter((b['is'] for b in beats), dtype=np.int32, count=len(beats))
+        segment_np = np.fromiter((b['segment'] for b in beats), dtype=np.int32, count=len(beats))
+        id_np = np.arange(len(beats), dtype=np.int32)
+        mod4_np = id_np & 3
+        loopable_np = id_np >= loop_bounds_begin
 
         # compute a coherent 'next' beat to play. This is always just the next ordinal beat
         # unless we're at the end of the song. Then it gets a little trickier.
 
         for beat in beats:
-            if beat == beats[-1]:
+            if beat['id'] == len(beats) - 1:
 
                 # if we're at the last beat, then we want to find a reasonable 'next' beat to play. It should (a) share the
                 # same cluster, (b) be in a logical place in its measure, (c) be after the computed loop_bounds_begin, and
@@ -590,27 +757,37 @@ class InfiniteJukebox(object):
             else:
                 beat['next'] = beat['id'] + 1
 
+        # the cluster, segment position and place in the measure of every beat's 'next' beat
+
+        next_np = np.fromiter((b['next'] for b in beats), dtype=np.int32, count=len(beats))
+        next_cluster_np = cluster_np[next_np]
+        next_is_np = is_np[next_np]
+        next_mod4_np = next_np & 3
+
+        for i, beat in enumerate(beats):
+
             # find all the beats that (a) are in the same cluster as the NEXT oridnal beat, (b) are of the same
             # cluster position as the next ordinal beat, (c) are in the same place in the measure as the NEXT beat,
             # (d) but AREN'T the next beat, and (e) AREN'T in the same cluster as the current beat.
             #
             # THAT collection of beats contains our jump candidates
 
-            jump_candidates = [bx['id'] for bx in beats[loop_bounds_begin:] if
-                               (bx['cluster'] == beats[beat['next']]['cluster']) and
-                               (bx['is'] == beats[beat['next']]['is']) and
-                               (bx['id'] % 4 == beats[beat['next']]['id'] % 4) and
-                               (bx['segment'] != beat['segment']) and
-                               (bx['id'] != beat['next'])]
+            mask = (loopable_np &
+                    (cluster_np == next_cluster_np[i]) &
+                    (is_np == next_is_np[i]) &
+                    (mod4_np == next_mod4_np[i]) &
+                    (segment_np != segment_np[i]) &
+                    (id_np != next_np[i]))
 
-            if jump_candidates:
-                beat['jump_candidates'] = jump_candidates
-            else:
-                beat['jump_candidates'] = []
+            beat['jump_candidates'] = np.flatnonzero(mask).tolist()
 
         # save off the segment count
 
-        self.segments = max([b['segment'] for b in beats]) + 1
+        self.segments = int(segment_np.max()) + 1
+
+        # and the number of beats that have somewhere to jump to
+
+        self.jump_points_count = sum(bool(b['jump_candidates']) for b in beats)
 
         # we don't want to ever play past the point where it's impossible to loop,
         # so let's find the latest point in the song where there are still jump
@@ -618,17 +795,17 @@ class InfiniteJukebox(object):
 
         last_chance = len(beats) - 1
 
-        for b in reversed(beats):
+        for ridx, b in enumerate(reversed(beats)):
             if len(b['jump_candidates']) > 0:
-                last_chance = beats.index(b)
+                last_chance = len(beats) - 1 - ridx
                 break
 
         # if we play our way to the last beat that has jump candidates, then just skip
         # to the earliest jump candidate rather than enter a section from which no
-        # jumping is possible.
+        # jumping is possible. (jump_candidates are in ascending order.)
 
         if beats[last_chance]['jump_candidates']:
-            beats[last_chance]['next'] = min(beats[last_chance]['jump_candidates'])
+            beats[last_chance]['next'] = beats[last_chance]['jump_candidates'][0]
         else:
             beats[last_chance]['next'] = 0
 
@@ -817,6 +994,72 @@ class InfiniteJukebox(object):
         if self.__progress_callback:
             self.__progress_callback( pct_done, message )
 
+    def __downbeat_activations(self, y, sr, num_threads):
+
+        """ Returns madmom's RNN downbeat activations for the mono samples y.
+
+            The RNN is by far the slowest part of beat finding, so its output is
+            cached next to the audio file. Only the cheap DBN decoding has to run
+            again when the downbeat cache is missing. The cache is tied to the
+            sample rate and length of y so a re-trimmed file recomputes it.
+        """
+
+        act_cache_filename = self.__filename + '_act.npz'
+
+        try:
+            with np.load(act_cache_filename, allow_pickle=False) as cached:
+                if cached['sr'] == sr and cached['num_samples'] == len(y):
+                    return cached['act']
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"Warning: Failed to read activation cache {act_cache_filename}. Error: {e}")
+
+        act = madmom.features.RNNDownBeatProcessor(num_threads=num_threads)(y).astype(np.float32)
+
+        try:
+            np.savez(act_cache_filename, act=act, sr=sr, num_samples=len(y))
+        except Exception as e:
+            print(f"Warning: Failed to write activation cache to {act_cache_filename}. Error: {e}")
+
+        return act
+
+    def __laplacian_eigenvectors(self, A, n_evecs):
+
+        """ Returns the n_evecs eigenvectors of the normalized Laplacian of A with the
+            smallest eigenvalues, in ascending order of eigenvalue.
+
+            L is symmetric by construction (A is symmetric and the normalized Laplacian
+            preserves that). Most songs go to a dense eigh(), which reads only the lower
+            triangle and itself rejects NaN/inf entries. For long songs, where that gets
+            expensive and A is mostly (near) zeros, the eigenvectors come from Lanczos
+            iteration on a sparse matrix instead.
+        """
+
+        N = A.shape[0]
+
+        if N >= self.SPARSE_EIGEN_MIN_BEATS:
+
+            keep = A >= self.SPARSE_AFFINITY_EPS
+
+            if np.count_nonzero(keep) <= self.SPARSE_EIGEN_MAX_DENSITY * N * N:
+
+                L = scipy.sparse.csgraph.laplacian(scipy.sparse.csr_matrix(np.where(keep, A, 0)), normed=True)
+
+                # the smallest eigenvalues of L are the largest of I - L, which Lanczos
+                # converges on without having to factorize the (singular) Laplacian
+                M = scipy.sparse.identity(N, dtype=L.dtype, format='csr') - L
+                _, evecs = scipy.sparse.linalg.eigsh(M, k=n_evecs, which='LA', tol=1e-4)
+
+                return evecs[:, ::-1]
+
+        # make sure L is contiguous
+        L = np.ascontiguousarray(scipy.sparse.csgraph.laplacian(A, normed=True))
+
+        _, evecs = scipy.linalg.eigh(L, lower=True, subset_by_index=[0, n_evecs - 1], driver='evr')
+
+        return evecs
+
     def __compute_best_cluster_with_sil(self, evecs, Cnorm):
 
         ''' Attempts to compute optimum clustering
@@ -871,6 +1114,11 @@ class InfiniteJukebox(object):
 
         self._clusters_list = []
 
+        # KMeans and the distance computations keep float32 input as float32, which halves
+        # the memory traffic of their inner loops. Single precision is plenty for these.
+        evecs = np.ascontiguousarray(evecs, dtype=np.float32)
+        Cnorm = np.ascontiguousarray(Cnorm, dtype=np.float32)
+
         best_cluster_size = 0
         best_labels = None
         best_cluster_score = 0
@@ -878,59 +1126,52 @@ class InfiniteJukebox(object):
         # we need at least 3 clusters for any song and shouldn't need to calculate more than
         # 48 clusters for even a really complicated peice of music.
 
-        for n_clusters in range(48, 2, -1):
+        self.__report_progress(.51, "Testing cluster values from %d to 3..." % self.MAX_SIL_CLUSTERS)
 
-            self.__report_progress(.51, "Testing a cluster value of %d..." % n_clusters)
+        inv_Cnorm = np.reciprocal(Cnorm, dtype=np.float32)
 
-            # compute a matrix of the Eigen-vectors / their normalized values
-            X = evecs[:, :n_clusters] / Cnorm[:, n_clusters-1:n_clusters]
+        # The silhouette scores only need distances between beats. Measure those once, in
+        # the space of all the normalized Eigen-vectors any candidate uses, and score every
+        # candidate's labels against the same distances rather than recomputing them per k.
 
-            # create the candidate clusters and fit them
-            clusterer = sklearn.cluster.KMeans(n_clusters=n_clusters, max_iter=300,
-                                               random_state=0, n_init=20)
+        X_all = self.__cluster_features(evecs, inv_Cnorm, min(self.MAX_SIL_CLUSTERS, evecs.shape[1]))
 
-            cluster_labels = clusterer.fit_predict(X)
+        # CLUSTER_GPU=1 runs the whole sweep on the GPU with cuML instead. The Eigen-vectors
+        # are uploaded once and only each candidate's labels come back to the host.
 
-            # get some key statistics, including how well each beat in the cluster resemble
-            # each other (the silhouette average), the ratio of segments to clusters, and the
-            # length of the smallest segment in this cluster configuration
+        if os.environ.get('CLUSTER_GPU', '0') == '1':
 
-            silhouette_avg = sklearn.metrics.silhouette_score(X, cluster_labels)
+            if cuml is None:
+                raise ImportError('CLUSTER_GPU=1 requires the cuml and cupy packages')
 
-            ratio, min_segment_len = self.__segment_stats_from_labels(cluster_labels.tolist())
+            evecs_gpu = cupy.asarray(evecs)
+            inv_Cnorm_gpu = cupy.asarray(inv_Cnorm)
+            X_all_gpu = cupy.asarray(X_all)
 
-            # We need to grade each cluster according to how likely it is to produce a good
-            # result. There are a few factors to look at.
-            #
-            # First, we can look at how similar the beats in each cluster (on average) are for
-            # this candidate cluster size. This is known as the silhouette score. It ranges
-            # from -1 (very bad) to 1 (very good).
-            #
-            # Another thing we can look at is the ratio of clusters to segments. Higher ratios
-            # are preferred because they afford each beat in a cluster the opportunity to jump
-            # around to meaningful places in the song.
-            #
-            # All other things being equal, we prefer a higher cluster count to a lower one
-            # because it will tend to make the jumps more selective -- and therefore higher
-            # quality.
-            #
-            # Lastly, if we see that we have segments equal to just one beat, that might be
-            # a sign of overfitting. We call these one beat segments 'orphans'. Some songs,
-            # however, will have orphans no matter what cluster count you use. So, we don't
-            # want to throw out a cluster count just because it has orphans. Instead, we
-            # just de-rate its fitness score. If most of the cluster candidates have orphans
-            # then this won't matter in the overall scheme because everyone will be de-rated
-            # by the same scaler.
+            results = [_fit_and_score_gpu(n_clusters, evecs_gpu[:, :n_clusters] * inv_Cnorm_gpu[:, n_clusters-1:n_clusters],
+                                          X_all_gpu)
+                       for n_clusters in range(self.MAX_SIL_CLUSTERS, 2, -1)]
+
+        else:
+
+            D = sklearn.metrics.pairwise_distances(X_all)
+
+            # every candidate cluster count is fitted and scored independently, so spread them
+            # over joblib workers. CLUSTER_JOBS caps the number of workers (default: one per core).
+            # The workers already split the cores between them, so keep each one's BLAS/OpenMP
+            # pools to a single thread rather than letting every worker start one per core.
+            # The refit below runs back in this process with its normal thread pools.
             #
-            # Putting this all together, we muliply the cluster count * the average
-            # silhouette score for the clusters in this candidate * the ratio of clusters to
-            # segments. Then we scale (or de-rate) the fitness score by whether or not is has
-            # orphans in it.
+            # D is N x N, so rather than pickling it into every task, joblib dumps any argument
+            # over max_nbytes to a memory-mapped file once and every worker maps it read-only.
 
-            orphan_scaler = .8 if min_segment_len == 1 else 1
+            with joblib.parallel_backend('loky', inner_max_num_threads=1):
+                results = joblib.Parallel(n_jobs=int(os.environ.get('CLUSTER_JOBS', -1)),
+                                          max_nbytes='1M', mmap_mode='r')(
+                    joblib.delayed(_fit_and_score)(n_clusters, self.__cluster_features(evecs, inv_Cnorm, n_clusters), D)
+                    for n_clusters in range(self.MAX_SIL_CLUSTERS, 2, -1))
 
-            cluster_score = n_clusters * silhouette_avg * ratio * orphan_scaler
-            #cluster_score = ((n_clusters/48.0) * silhouette_avg * (ratio/10.0)) * orphan_scaler
+        for n_clusters, cluster_labels, cluster_score in results:
 
             # if this cluster count has a score that's better than the best score so far, store
             # it for later.
@@ -940,52 +1181,47 @@ class InfiniteJukebox(object):
                 best_cluster_size = n_clusters
                 best_labels = cluster_labels
 
+        # the screening labels came from a quick randomly seeded fit; recompute the
+        # winner's clusters with k-means++ and more restarts
+        if best_cluster_size > 0:
+            X = self.__cluster_features(evecs, inv_Cnorm, best_cluster_size)
+            best_labels = sklearn.cluster.KMeans(n_clusters=best_cluster_size, max_iter=300,
+                                                 random_state=0, n_init=20, copy_x=False).fit_predict(X)
+
         # return the best results
         return (best_cluster_size, best_labels)
 
     @staticmethod
-    def __segment_count_from_labels(labels):
-
-        ''' Computes the number of unique segments from a set of ordered labels. Segements are
-            contiguous beats that belong to the same cluster. '''
-
-        segment_count = 0
-        previous_label = -1
+    def __cluster_features(evecs, inv_Cnorm, k, out=None):
 
-        for label in labels:
-            if label != previous_label:
-                previous_label = label
-                segment_count += 1
+        ''' Returns the first k Eigen-vectors normalized by Cnorm as a C-contiguous float32
+            matrix, which KMeans can consume without making its own copy. Cnorm is passed
+            in as its reciprocal so callers trying many values of k only divide once.
 
-        return segment_count
+            If out is given -- a flat float32 buffer with room for the whole matrix -- the
+            matrix is written into the front of it and returned as a view, so a caller
+            going through many values of k can reuse one allocation. (A column slice of
+            a 2-D buffer wouldn't do: it isn't contiguous, so KMeans would copy it.) '''
 
-    def __segment_stats_from_labels(self, labels):
-        ''' Computes the segment/cluster ratio and min segment size value given an array
-            of labels. '''
+        if out is None:
+            return np.multiply(evecs[:, :k], inv_Cnorm[:, k-1:k], dtype=np.float32)
 
-        segment_count = 0.0
-        segment_length = 0
-        clusters = max(labels) + 1
+        features = evecs[:, :k]
 
-        previous_label = -1
+        return np.multiply(features, inv_Cnorm[:, k-1:k], out=out[:features.size].reshape(features.shape))
 
-        segment_lengths = []
-
-        for label in labels:
-            if label != previous_label:
-                previous_label = label
-                segment_count += 1.0
+    @staticmethod
+    def __segment_count_from_labels(labels):
 
-                if segment_length > 0:
-                    segment_lengths.append(segment_length)
+        ''' Computes the number of unique segments from a set of ordered labels. Segements are
+            contiguous beats that belong to the same cluster. '''
 
-                segment_length = 1
-            else:
-                segment_length +=1
+        labels = np.asarray(labels)
 
-        # self.__report_progress( .52, "clusters: %d,  ratio: %f,  min_seg: %d" % (clusters, segment_count/len(labels), segment_length) )
+        if labels.size == 0:
+            return 0
 
-        return float(segment_count) / float(clusters), min(segment_lengths)
+        return int(np.count_nonzero(labels[1:] != labels[:-1])) + 1
 
     def __compute_best_cluster(self, evecs, Cnorm):
 
@@ -1025,44 +1261,42 @@ class InfiniteJukebox(object):
 
         self._clusters_list = []
 
+        # KMeans and the distance computations keep float32 input as float32, which halves
+        # the memory traffic of their inner loops. Single precision is plenty for these.
+        evecs = np.ascontiguousarray(evecs, dtype=np.float32)
+        Cnorm = np.ascontiguousarray(Cnorm, dtype=np.float32)
+
+        inv_Cnorm = np.reciprocal(Cnorm, dtype=np.float32)
+
         # We compute the clusters between 4 and 64. Owing to the inherent
         # symmetry of Western popular music (including Jazz and Classical), the most
         # pleasing musical results will often, though not always, come from even cluster values.
 
-        for ki in range(4,64, 2):
+        # every candidate's features are written into the same buffer, sized for the largest
+        X_buf = np.empty(evecs.shape[0] * min(self.MAX_V1_CLUSTERS, evecs.shape[1]), dtype=np.float32)
+
+        for ki in range(4, self.MAX_V1_CLUSTERS + 1, 2):
 
             # compute a matrix of the Eigen-vectors / their normalized values
-            X = evecs[:, :ki] / Cnorm[:, ki-1:ki]
+            X = self.__cluster_features(evecs, inv_Cnorm, ki, out=X_buf)
 
             # cluster with candidate ki
             labels = sklearn.cluster.KMeans(n_clusters=ki, max_iter=1000,
-                                            random_state=0, n_init=20).fit_predict(X)
+                                            random_state=0, n_init=20, copy_x=False).fit_predict(X)
 
             entry = {'clusters':ki, 'labels':labels}
 
-            # create an array of dictionary entries containing (a) the cluster label,
-            # (b) the number of total beats that belong to that cluster, and
-            # (c) the number of segments in which that cluster appears.
-
-            lst = []
-
-            for i in range(0,ki):
-                lst.append( {'label':i, 'beats':0, 'segs':0} )
+            # count (a) the number of total beats that belong to each cluster, and
+            # (b) the number of segments in which each cluster appears. A segment
+            # starts at the first beat and wherever the label changes.
 
-            last_label = -1
+            seg_starts = np.concatenate(([True], labels[1:] != labels[:-1]))
 
-            for l in labels:
-
-                if l != last_label:
-                    lst[l]['segs'] += 1
-                    last_label = l
-
-                lst[l]['beats'] += 1
-
-            entry['cluster_map'] = lst
+            entry['beats_per_label'] = np.bincount(labels, minlength=ki)
+            entry['segs_per_label'] = np.bincount(labels[seg_starts], minlength=ki)
 
             # get the average number of segments to which a cluster belongs
-            entry['seg_ratio'] = np.mean([l['segs'] for l in entry['cluster_map']])
+            entry['seg_ratio'] = entry['segs_per_label'].mean()
 
             self._clusters_list.append(entry)
 
@@ -1074,12 +1308,9 @@ class InfiniteJukebox(object):
 
         final_cluster_size = max(cl['clusters'] for cl in self._clusters_list if cl['seg_ratio'] >= max_seg_ratio)
 
-        # compute a very high fidelity set of clusters using our selected cluster size.
-        X = evecs[:, :final_cluster_size] / Cnorm[:, final_cluster_size-1:final_cluster_size]
-        labels = sklearn.cluster.KMeans(n_clusters=final_cluster_size, max_iter=1000,
-                                        random_state=0, n_init=1000).fit_predict(X)
-
-        # labels = next(c['labels'] for c in self._clusters_list if c['clusters'] == final_cluster_size)
+        # the sweep already fit this cluster size with 20 k-means++ restarts on the same
+        # features, so its labels are as good as a refit would give. Reuse them.
+        labels = next(c['labels'] for c in self._clusters_list if c['clusters'] == final_cluster_size)
 
         # return a tuple of (winning cluster size, [array of cluster labels for the beats])
         return (final_cluster_size, labels)
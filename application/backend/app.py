@@ -5,8 +5,21 @@ import json
 import pickle
 import gzip
 import traceback
-import base64
+import logging
+import multiprocessing
+import hashlib
+import struct
+import threading
+import queue
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
 import numpy as np
+import orjson
+import pyarrow as pa
+import pyarrow.feather as feather
+import zstandard as zstd
+from cachetools import LRUCache, TTLCache
 from flask import Flask, request, jsonify, send_file
 from flask_cors import CORS
 from werkzeug.utils import secure_filename
@@ -14,18 +27,31 @@ from werkzeug.utils import secure_filename
 # Import the song mapper
 import song_mapper
 
-# Add the remixatron directory to the path
-sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'exploration/remixatron'))
+# Add the remixatron directory to the path, once per interpreter (worker processes re-import this module)
+REMIXATRON_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'exploration/remixatron')
+if REMIXATRON_PATH not in sys.path:
+    sys.path.append(REMIXATRON_PATH)
 
 # Import the InfiniteJukebox class
 from Remixatron import InfiniteJukebox
 
+# Surface song_mapper's log records (INFO and up) alongside the prints
+logging.basicConfig(level=logging.INFO)
+
 app = Flask(__name__)
 app.json.ensure_ascii = False
 CORS(app)
 
-# Initialize the song mapper
-song_db = song_mapper.get_instance()
+# The jukebox pool's children (started by the forkserver below) re-import this module just to
+# run process_song, which needs neither the database nor the background threads
+IN_JUKEBOX_WORKER = multiprocessing.parent_process() is not None
+
+# Initialize the song mapper. SONG_DB_IN_MEMORY serves the database from memory, which is
+# only consistent when a single process serves requests (e.g. WEB_CONCURRENCY=1). Its writes
+# are flushed to disk every SONG_DB_FLUSH_INTERVAL seconds and on shutdown.
+SONG_DB_IN_MEMORY = os.environ.get('SONG_DB_IN_MEMORY', '').lower() in ('1', 'true', 'yes')
+SONG_DB_FLUSH_INTERVAL = float(os.environ.get('SONG_DB_FLUSH_INTERVAL', 30))
+song_db = None if IN_JUKEBOX_WORKER else song_mapper.get_instance(in_memory=SONG_DB_IN_MEMORY)
 
 # Configure upload folder
 UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uploads')
@@ -35,27 +61,345 @@ app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 32 * 1024 * 1024  # Increased to 32MB max upload size
 app.config['TIMEOUT'] = 300  # 5 minutes timeout
 
-# Store processed songs
-processed_songs = {}
+# When running behind nginx, let it serve audio files from the uploads folder itself via
+# X-Accel-Redirect (zero-copy sendfile) instead of streaming them through Python
+app.config['USE_X_ACCEL_REDIRECT'] = os.environ.get('USE_X_ACCEL_REDIRECT', '').lower() in ('1', 'true', 'yes')
+app.config['X_ACCEL_REDIRECT_PREFIX'] = os.environ.get('X_ACCEL_REDIRECT_PREFIX', '/_protected_uploads/')
+
+# Read uploads in 1 MiB chunks when streaming them to disk
+UPLOAD_CHUNK_SIZE = 1 << 20
+
+# Song rows are written to the database by a single background thread that batches
+# inserts into one transaction, so uploads never wait on a database commit.
+SONG_WRITE_BATCH_SIZE = 100
+SONG_WRITE_INTERVAL = 0.05  # seconds to wait for more rows before flushing a batch
+song_write_queue = queue.Queue()
+
+def queue_song_write(**song):
+    """Queue a song row (the keyword arguments of SongMapper.add_song) for the writer thread"""
+    song_write_queue.put(song)
+
+# Song rows are read on every /segments, /uploads and /songs/<song_id> request, so keep
+# recently read ones for a short while. PENDING rows are not cached, so status polls
+# see the change as soon as the row is written (possibly by another worker process).
+song_cache = TTLCache(maxsize=1024, ttl=30)
+song_cache_lock = threading.Lock()
 
-def decode_filename(encoded_filename):
-    """Decode a base64 encoded filename back to its original form with Chinese characters"""
+def lookup_song(song_id):
+    """song_db.get_song_tuple (a SongRow), answered from song_cache when possible"""
+    with song_cache_lock:
+        song = song_cache.get(song_id)
+    if song is None:
+        song = song_db.get_song_tuple(song_id)
+        if song is not None and song.status == song_mapper.STATUS_PENDING:
+            song = expire_stale_pending(song)
+        if song is not None and song.status != song_mapper.STATUS_PENDING:
+            with song_cache_lock:
+                song_cache[song_id] = song
+    return song
+
+# Every web worker refreshes updated_at on the PENDING rows it has queued or running once per
+# PENDING_HEARTBEAT_INTERVAL. A PENDING row whose heartbeat is older than PENDING_TIMEOUT has
+# lost its job (e.g. the gunicorn worker that owned it died), so it is marked ERROR rather
+# than left PENDING forever. This works across workers since it only looks at the row.
+PENDING_HEARTBEAT_INTERVAL = 60  # seconds
+PENDING_TIMEOUT = int(os.environ.get('PENDING_TIMEOUT', 10 * 60))  # seconds
+
+def expire_stale_pending(song):
+    """Mark a PENDING song as ERROR if its heartbeat is older than PENDING_TIMEOUT"""
+    # SQLite's CURRENT_TIMESTAMP (UTC). Rows written before updated_at existed only have created_at.
+    last_seen = song.updated_at or song.created_at
     try:
-        # Extract the encoded part (before the hash)
-        encoded_part = encoded_filename.split('_')[0]
-        original = base64.urlsafe_b64decode(encoded_part.encode('ascii')).decode('utf-8')
-        return original
-    except Exception as e:
-        print(f"Error decoding filename: {str(e)}")
-        return encoded_filename
+        last_seen_at = datetime.strptime(last_seen, '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc)
+    except (TypeError, ValueError):
+        return song
+    if (datetime.now(timezone.utc) - last_seen_at).total_seconds() < PENDING_TIMEOUT:
+        return song
+
+    print(f"Song {song.song_id} has had no processing heartbeat since {last_seen}, marking it {song_mapper.STATUS_ERROR}")
+    queue_song_write(
+        song_id=song.song_id,
+        original_filename=song.original_filename,
+        encoded_filename=song.encoded_filename,
+        file_path=song.file_path,
+        mime=song.mime,
+        status=song_mapper.STATUS_ERROR
+    )
+    return song._replace(status=song_mapper.STATUS_ERROR)
+
+def song_writer():
+    """Drain queued song rows and write them to the database in batches"""
+    while True:
+        rows = [song_write_queue.get()]
+        deadline = time.monotonic() + SONG_WRITE_INTERVAL
+        while len(rows) < SONG_WRITE_BATCH_SIZE:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                rows.append(song_write_queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        try:
+            song_db.bulk_add_songs(rows)
+        except Exception as e:
+            # bulk_add_songs logs database errors itself; anything else must not kill this thread
+            print(f"Error writing {len(rows)} songs to database: {str(e)}")
+            print(traceback.format_exc())
+        with song_cache_lock:
+            for row in rows:
+                song_cache.pop(row['song_id'], None)
+        for _ in rows:
+            song_write_queue.task_done()
+
+def pending_heartbeat():
+    """Periodically mark this worker's queued and running songs as still alive"""
+    while True:
+        time.sleep(PENDING_HEARTBEAT_INTERVAL)
+        with pending_jobs_lock:
+            song_ids = list(pending_jobs)
+        if song_ids:
+            try:
+                song_db.touch_songs(song_ids)
+            except Exception as e:
+                # touch_songs logs database errors itself; anything else must not kill this thread
+                print(f"Error refreshing {len(song_ids)} pending songs: {str(e)}")
+
+def song_db_flusher():
+    """Periodically back the in-memory song database up to disk"""
+    while True:
+        time.sleep(SONG_DB_FLUSH_INTERVAL)
+        try:
+            song_db.flush()
+        except Exception as e:
+            print(f"Error flushing song database: {str(e)}")
+
+if not IN_JUKEBOX_WORKER:
+    threading.Thread(target=song_writer, name='song-writer', daemon=True).start()
+    threading.Thread(target=pending_heartbeat, name='pending-heartbeat', daemon=True).start()
+    if SONG_DB_IN_MEMORY:
+        threading.Thread(target=song_db_flusher, name='song-db-flusher', daemon=True).start()
+
+# Keep the most recently used processed songs in memory. Older entries are evicted and
+# reloaded from the on-disk segments cache on demand.
+processed_songs = LRUCache(maxsize=int(os.environ.get('SONG_CACHE', 32)))
+processed_songs_lock = threading.Lock()
+
+# InfiniteJukebox processing is CPU bound and can take minutes, so it runs in a pool of
+# worker processes instead of on the request thread
+JUKEBOX_WORKERS = int(os.environ.get('JUKEBOX_WORKERS', os.cpu_count()))
+# madmom's threads and the cluster search's joblib workers run inside each of those
+# processes, so split the cores between them
+CORES_PER_JUKEBOX_WORKER = str(max(1, os.cpu_count() // JUKEBOX_WORKERS))
+os.environ.setdefault('MADMOM_THREADS', CORES_PER_JUKEBOX_WORKER)
+os.environ.setdefault('CLUSTER_JOBS', CORES_PER_JUKEBOX_WORKER)
+# Children are started lazily from a request thread while the song writer and other request
+# threads are running, so fork() would copy their held locks and the sqlite connection into
+# the child. Start them from a clean forkserver process instead.
+executor = None if IN_JUKEBOX_WORKER else ProcessPoolExecutor(
+    max_workers=JUKEBOX_WORKERS, mp_context=multiprocessing.get_context('forkserver'))
+pending_jobs = {}
+pending_jobs_lock = threading.Lock()
+
+def drain_background_work():
+    """Wait for in-flight song processing and the song rows it queues to be written"""
+    executor.shutdown(wait=True)
+    song_write_queue.join()
+    song_db.flush()
+
+ORJSON_OPTIONS = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+
+AUDIO_MIMETYPES = {
+    '.mp3': 'audio/mpeg',
+    '.wav': 'audio/wav',
+    '.ogg': 'audio/ogg',
+    '.flac': 'audio/flac',
+}
+
+def guess_audio_mimetype(filename):
+    """Map an audio filename to its mimetype by extension, defaulting to MP3"""
+    return AUDIO_MIMETYPES.get(os.path.splitext(filename)[1].lower(), 'audio/mpeg')
+
+def ojson(obj, status=200):
+    """Build a JSON response with orjson, which serializes NumPy arrays and scalars natively"""
+    return app.response_class(
+        orjson.dumps(obj, option=ORJSON_OPTIONS),
+        status=status,
+        mimetype='application/json'
+    )
+
+SEGMENTS_CACHE_SUFFIX = '_segments.json.zst'
+
+def save_segments_cache(file_path, payload):
+    """Write the serialized segments payload for a song next to its audio file"""
+    segments_cache_filename = file_path + SEGMENTS_CACHE_SUFFIX
+    with open(segments_cache_filename, 'wb') as f:
+        f.write(zstd.compress(orjson.dumps(payload, option=ORJSON_OPTIONS), 3))
+    return segments_cache_filename
+
+def load_segments_cache(file_path):
+    """Return the cached JSON bytes of a song's segments payload. Raises FileNotFoundError on a miss."""
+    with open(file_path + SEGMENTS_CACHE_SUFFIX, 'rb') as f:
+        return zstd.decompress(f.read())
+
+# Beats are also kept as a columnar Arrow (Feather v2) table, with the song-level fields in
+# the schema metadata. Reading it back is much cheaper than unpickling the whole jukebox,
+# which also carries the decoded audio.
+BEATS_TABLE_SUFFIX = '_beats.arrow'
+
+# Only these per-beat fields are stored. Any others (e.g. the raw audio 'buffer' that older
+# jukeboxes carry) are left out rather than having pyarrow guess at their types.
+BEATS_TABLE_SCHEMA = pa.schema([
+    ('id', pa.int32()),
+    ('start', pa.float64()),
+    ('duration', pa.float64()),
+    ('amplitude', pa.float64()),
+    ('cluster', pa.int32()),
+    ('segment', pa.int32()),
+    ('is', pa.int32()),
+    ('quartile', pa.float64()),
+    ('next', pa.int32()),
+    ('jump_candidates', pa.list_(pa.int32())),
+])
+
+def save_beats_table(file_path, jukebox):
+    """Write a processed jukebox's beats as a zstd-compressed Feather file next to its audio file"""
+    table = pa.Table.from_pylist(jukebox.beats, schema=BEATS_TABLE_SCHEMA).replace_schema_metadata({
+        'duration': str(jukebox.duration),
+        'tempo': str(jukebox.tempo),
+        'sample_rate': str(jukebox.sample_rate),
+    })
+    beats_table_filename = file_path + BEATS_TABLE_SUFFIX
+    feather.write_feather(table, beats_table_filename, compression='zstd')
+    return beats_table_filename
+
+def load_beats_table(file_path, original_filename):
+    """Rebuild a song's segments payload from its beats table. Raises FileNotFoundError on a miss."""
+    table = feather.read_table(file_path + BEATS_TABLE_SUFFIX)
+    metadata = table.schema.metadata
+    return {
+        'filename': original_filename,
+        'segments': table.to_pylist(),
+        'duration': float(metadata[b'duration']),
+        'tempo': float(metadata[b'tempo']),
+        'sample_rate': int(metadata[b'sample_rate'])
+    }
+
+# Strong ETags must differ between content-codings, so the zstd-encoded segments get their own
+ZSTD_ETAG_SUFFIX = '-zstd'
+
+def with_song_etag(response, song_id, zstd_encoded=False):
+    """Tag a segments response with its song_id, which already embeds the audio's SHA-256"""
+    response.set_etag(song_id + ZSTD_ETAG_SUFFIX if zstd_encoded else song_id)
+    response.vary.add('Accept-Encoding')
+    return response
+
+def save_and_hash_stream(stream, dest_path):
+    """Copy a binary stream to dest_path and return the SHA-256 hex digest of its contents.
+
+    A single buffer is reused via readinto() so no per-chunk bytes objects are created,
+    and hashlib's OpenSSL backend picks up SHA-NI / ARMv8 SHA2 instructions when available.
+    """
+    hasher = hashlib.sha256()
+    with open(dest_path, 'wb') as out:
+        if hasattr(stream, 'readinto'):
+            buf = bytearray(UPLOAD_CHUNK_SIZE)
+            view = memoryview(buf)
+            while True:
+                n = stream.readinto(buf)
+                if not n:
+                    break
+                hasher.update(view[:n])
+                out.write(view[:n])
+        else:
+            while True:
+                chunk = stream.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                hasher.update(chunk)
+                out.write(chunk)
+    return hasher.hexdigest()
+
+# Jukebox caches are stored as a pickle protocol 5 stream followed by its out-of-band
+# buffers, so NumPy arrays are written straight from their memory instead of being
+# copied into the pickle bytes. Layout (inside the zstd frame):
+#   magic | <Q pickle length> | <Q buffer count> | pickle | (<Q buffer length> | buffer)*
+JUKEBOX_CACHE_MAGIC = b'IWJB5'
+
+def _read_exact(reader, size):
+    """Read exactly size bytes from reader into a writable bytearray"""
+    buf = bytearray(size)
+    view = memoryview(buf)
+    pos = 0
+    while pos < size:
+        n = reader.readinto(view[pos:])
+        if not n:
+            raise EOFError(f"Unexpected end of jukebox cache after {pos} of {size} bytes")
+        pos += n
+    return buf
+
+def load_jukebox(jukebox_pickled_filename):
+    """Load a pickled jukebox, preferring the zstd cache and falling back to the legacy gzip one.
+
+    Returns a (jukebox, cache_path) tuple. Raises FileNotFoundError if neither cache exists.
+    """
+    zst_path = jukebox_pickled_filename + '.zst'
+    try:
+        with open(zst_path, 'rb') as f, zstd.ZstdDecompressor().stream_reader(f) as reader:
+            if bytes(_read_exact(reader, len(JUKEBOX_CACHE_MAGIC))) != JUKEBOX_CACHE_MAGIC:
+                raise ValueError(f"Unrecognized jukebox cache format in {zst_path}")
+            data_len, buffer_count = struct.unpack('<QQ', _read_exact(reader, 16))
+            data = _read_exact(reader, data_len)
+            buffers = []
+            for _ in range(buffer_count):
+                (buffer_len,) = struct.unpack('<Q', _read_exact(reader, 8))
+                buffers.append(_read_exact(reader, buffer_len))
+            return pickle.loads(data, buffers=buffers), zst_path
+    except FileNotFoundError:
+        pass
+
+    gz_path = jukebox_pickled_filename + '.gz'
+    with gzip.open(gz_path, 'rb') as f:
+        return pickle.load(f), gz_path
+
+def save_jukebox(jukebox, jukebox_pickled_filename):
+    """Pickle a jukebox into a zstd compressed cache file and return its path"""
+    buffers = []
+    data = pickle.dumps(jukebox, protocol=5, buffer_callback=buffers.append)
+
+    zst_path = jukebox_pickled_filename + '.zst'
+    with open(zst_path, 'wb') as f, zstd.ZstdCompressor(level=3, threads=-1).stream_writer(f) as writer:
+        writer.write(JUKEBOX_CACHE_MAGIC)
+        writer.write(struct.pack('<QQ', len(data), len(buffers)))
+        writer.write(data)
+        for buffer in buffers:
+            raw = buffer.raw()
+            writer.write(struct.pack('<Q', raw.nbytes))
+            writer.write(raw)
+    return zst_path
 
 def progress_callback(pct_complete, message):
     """Callback function for InfiniteJukebox progress updates"""
     print(f"[{pct_complete}]: {message}")
 
+def check_upload_length():
+    """Reject missing, empty or oversized upload bodies from the headers alone, before any parsing or hashing"""
+    content_length = request.content_length
+    if content_length is None:
+        return jsonify({'error': 'Content-Length header is required'}), 411
+    if content_length == 0:
+        return jsonify({'error': 'Empty request body'}), 400
+    if content_length > app.config['MAX_CONTENT_LENGTH']:
+        return jsonify({'error': f"Upload exceeds the {app.config['MAX_CONTENT_LENGTH']} byte limit"}), 413
+    return None
+
 @app.route('/upload', methods=['POST'])
 def upload_file():
     try:
+        length_error = check_upload_length()
+        if length_error:
+            return length_error
+
         if 'file' not in request.files:
             return jsonify({'error': 'No file part'}), 400
         
@@ -69,243 +413,384 @@ def upload_file():
             # Preserve original filename by encoding it to base64 instead of using secure_filename
             # This ensures Chinese characters are preserved
             original_filename = file.filename
-            encoded_filename = base64.urlsafe_b64encode(original_filename.encode('utf-8')).decode('ascii')
+            encoded_filename = song_mapper.b64url_encode(original_filename)
                         
-            try:
-                # Generate deterministic ID by hashing the file contents
-                file_contents = file.read()
-                # Generate deterministic ID using SHA-256 hash of file contents
-                import hashlib
-                song_id = encoded_filename + '_' + hashlib.sha256(file_contents).hexdigest()
-                file.seek(0)  # Reset file pointer after reading
-                
-                # Save the file
-                # filename = secure_filename(file.filename)
-                file_path = os.path.join(app.config['UPLOAD_FOLDER'], f"{song_id}")
-                file.save(file_path)
-                
-                print(f"Song {original_filename} saved to {file_path}")
-
-                # Check if file exists and is readable
-                if not os.path.exists(file_path):
-                    return jsonify({'error': f'Song {file.filename} not saved properly to {file_path}'}), 500
-                
-                # Get file size
-                file_size = os.path.getsize(file_path)
-                print(f"File size: {file_size} bytes")
-                
-                if file_size == 0:
-                    return jsonify({'error': f'Uploaded song {original_filename} is empty'}), 400
-                
-            except Exception as e:
-                print(f"Error checking file: {str(e)}")
-                print(traceback.format_exc())
-                return jsonify({'error': f'Error reading or relocating song {original_filename}: {str(e)}'}), 500
-            
-            # Load cached beats if available
-            beats_cache_filename = file_path + '_beats.npy'
-            cached_beats = np.array([])
+            return ingest_song(file.stream, original_filename, encoded_filename)
+
+    except Exception as e:
+        print(f"Unexpected error in upload_file: {str(e)}")
+        print(traceback.format_exc())
+        return jsonify({'error': f'Unexpected error: {str(e)}'}), 500
+    
+    return jsonify({'error': 'Failed to process file'}), 500
+
+@app.route('/upload_raw/<encoded_filename>', methods=['PUT'])
+def upload_raw(encoded_filename):
+    """Accept the audio file as the raw request body, bypassing multipart form parsing.
+
+    The original filename is passed in the URL, base64 (urlsafe) encoded.
+    """
+    try:
+        length_error = check_upload_length()
+        if length_error:
+            return length_error
+
+        try:
+            original_filename = song_mapper.b64url_decode(encoded_filename)
+        except Exception as e:
+            return jsonify({'error': f'Invalid encoded filename {encoded_filename}: {str(e)}'}), 400
+
+        if original_filename == '':
+            return jsonify({'error': 'No selected file'}), 400
+
+        # The decoder accepts padded and unpadded input, so re-encode the name rather than
+        # trusting the URL: the same file must always get the same song_id
+        encoded_filename = song_mapper.b64url_encode(original_filename)
+
+        return ingest_song(request.stream, original_filename, encoded_filename)
+
+    except Exception as e:
+        print(f"Unexpected error in upload_raw: {str(e)}")
+        print(traceback.format_exc())
+        return jsonify({'error': f'Unexpected error: {str(e)}'}), 500
+
+def ingest_song(stream, original_filename, encoded_filename):
+    """Save an uploaded song stream to disk, process it with InfiniteJukebox and build the response"""
+    tmp_path = None
+    try:
+        # Stream the upload to a temporary file while hashing it, so the
+        # contents are only walked once and never held fully in memory
+        tmp_path = os.path.join(app.config['UPLOAD_FOLDER'], f"{uuid.uuid4().hex}.part")
+        file_hash = save_and_hash_stream(stream, tmp_path)
+
+        # Generate deterministic ID using SHA-256 hash of file contents
+        song_id = encoded_filename + '_' + file_hash
+
+        # Move the file to its final location
+        file_path = os.path.join(app.config['UPLOAD_FOLDER'], f"{song_id}")
+        os.replace(tmp_path, file_path)
+
+        print(f"Song {original_filename} saved to {file_path}")
+
+        # Check if file exists and is readable
+        if not os.path.exists(file_path):
+            return jsonify({'error': f'Song {original_filename} not saved properly to {file_path}'}), 500
         
-            try:
-                cached_beats = np.load(beats_cache_filename)
-                print(f"Loaded beat cache from {beats_cache_filename}")
-            except FileNotFoundError:
-                print(f"No beats cache file found: '{beats_cache_filename}'")
-            except Exception as e:
-                print(f"Warning: Error loading beat cache '{beats_cache_filename}': {e}")
+        # Get file size
+        file_size = os.path.getsize(file_path)
+        print(f"File size: {file_size} bytes")
+        
+        if file_size == 0:
+            return jsonify({'error': f'Uploaded song {original_filename} is empty'}), 400
+        
+    except Exception as e:
+        print(f"Error checking file: {str(e)}")
+        print(traceback.format_exc())
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return jsonify({'error': f'Error reading or relocating song {original_filename}: {str(e)}'}), 500
+    
+    # Uploads are stored without an extension, so remember the audio type up front
+    mime = guess_audio_mimetype(original_filename)
 
+    # If this song has been processed before, answer straight from the jukebox cache
+    jukebox_pickled_filename = file_path + '_jukebox.pkl'
+    jukebox = None
 
-            
-            # try to load pickled jukebox
-            jukebox_pickled_filename = file_path + '_jukebox.pkl'
-            jukebox = None
+    try:
+        jukebox, cache_path = load_jukebox(jukebox_pickled_filename)
+        print(f"Loaded compressed pickled jukebox for song {original_filename} from {cache_path}")
+    except FileNotFoundError:
+        print(f"No compressed pickled jukebox file found: '{jukebox_pickled_filename}'")
+    except Exception as e:
+        print(f"Warning: Error loading compressed pickled jukebox '{jukebox_pickled_filename}': {e}")
 
-            try:
-                with gzip.open(jukebox_pickled_filename + '.gz', 'rb') as f:
-                    jukebox = pickle.load(f)
-                print(f"Loaded compressed pickled jukebox for song {original_filename} from {jukebox_pickled_filename}.gz")
-            except FileNotFoundError:
-                print(f"No compressed pickled jukebox file found: '{jukebox_pickled_filename}.gz'")
-            except Exception as e:
-                print(f"Warning: Error loading compressed pickled jukebox '{jukebox_pickled_filename}.gz': {e}")
-
-            if jukebox is None:
-                # Process song with InfiniteJukebox
-                try:
-                    print(f"Starting to process file with InfiniteJukebox...")
-
-                    jukebox = InfiniteJukebox(
-                        filename=file_path,
-                        progress_callback=progress_callback,
-                        do_async=False,
-                        starting_beat_cache=cached_beats
-                    )
-                    
-                    # Check if beats were properly detected
-                    if not hasattr(jukebox, 'beats') or len(jukebox.beats) == 0:
-                        return jsonify({'error': 'No beats detected in the audio file'}), 400
-                    
-                    # Save the jukebox object as a pickled file for future use
-                    try:
-                        with gzip.open(jukebox_pickled_filename + '.gz', 'wb') as f:
-                            pickle.dump(jukebox, f, protocol=pickle.HIGHEST_PROTOCOL)
-                        print(f"Successfully saved compressed pickled jukebox to {jukebox_pickled_filename}.gz")
-                    except Exception as e:
-                        print(f"Warning: Error saving compressed pickled jukebox '{jukebox_pickled_filename}.gz': {e}")
-                    
-                    print(f"Successfully processed song {original_filename}. Found {len(jukebox.beats)} beats.")
-
-                except Exception as e:
-                    print(f"Error in InfiniteJukebox processing: {str(e)}")
-                    print(traceback.format_exc())
-                    return jsonify({'error': f'Error processing audio: {str(e)}'}), 500
-
-
-            # Convert beats to a serializable format
-            segments = []
-            for beat in jukebox.beats:
-                # Remove the buffer which is not JSON serializable
-                beat_copy = beat.copy()
-                # if 'buffer' in beat_copy:
-                #     del beat_copy['buffer']
-                # if 'start_index' in beat_copy:
-                #     del beat_copy['start_index']
-                # if 'stop_index' in beat_copy:
-                #     del beat_copy['stop_index']
-                segments.append(beat_copy)
-            
-            # Store the processed data
-            processed_songs[song_id] = {
-                'filename': original_filename,
-                'segments': segments,
-                'duration': jukebox.duration,
-                'tempo': float(jukebox.tempo),
-                'sample_rate': jukebox.sample_rate
-            }
-            
-            # Store song information in the database
-            # Calculate the number of clusters
-            clusters_count = None
-            if hasattr(jukebox, 'clusters'):
-                if isinstance(jukebox.clusters, (list, tuple, set)):
-                    clusters_count = len(jukebox.clusters)
-                elif isinstance(jukebox.clusters, int):
-                    # If clusters is already an integer count, use it directly
-                    clusters_count = jukebox.clusters
-            
-            # Calculate total jump points by counting beats that have jump_candidates
-            jump_points_count = 0
-            for beat in jukebox.beats:
-                # Check if the beat has jump_candidates and it's not empty
-                if (isinstance(beat, dict) and
-                    'jump_candidates' in beat and
-                    beat['jump_candidates'] and
-                    len(beat['jump_candidates']) > 0):
-                    jump_points_count += 1
-            
-            song_db.add_song(
+    if jukebox is None:
+        # Otherwise hand the song to a background worker and let the client poll
+        # /songs/<song_id> until its status is DONE
+        submit_song_processing(song_id, original_filename, encoded_filename, file_path, mime)
+        return ojson({
+            'filename': original_filename,
+            'song_id': song_id,
+            'status': song_mapper.STATUS_PENDING
+        }, status=202)
+
+    payload = build_segments_payload(jukebox, original_filename)
+    with processed_songs_lock:
+        processed_songs[song_id] = payload
+
+    # Cache the serialized payload so later GETs skip unpickling and encoding
+    try:
+        save_segments_cache(file_path, payload)
+    except Exception as e:
+        print(f"Warning: Error saving segments cache for '{file_path}': {e}")
+
+    if not os.path.exists(file_path + BEATS_TABLE_SUFFIX):
+        try:
+            save_beats_table(file_path, jukebox)
+        except Exception as e:
+            print(f"Warning: Error saving beats table for '{file_path}': {e}")
+
+    # Store song information in the database
+    queue_song_write(
+        song_id=song_id,
+        original_filename=original_filename,
+        encoded_filename=encoded_filename,
+        file_path=file_path,
+        mime=mime,
+        status=song_mapper.STATUS_DONE,
+        **summarize_jukebox(jukebox)
+    )
+
+    return ojson(dict(payload, song_id=song_id))
+
+def build_segments_payload(jukebox, original_filename):
+    """Build the /segments response body for a processed jukebox"""
+    return {
+        'filename': original_filename,
+        # The beats are already plain dicts that orjson can serialize directly
+        'segments': jukebox.beats,
+        'duration': jukebox.duration,
+        'tempo': jukebox.tempo,
+        'sample_rate': jukebox.sample_rate
+    }
+
+def summarize_jukebox(jukebox):
+    """Collect the song metadata stored in the database for a processed jukebox"""
+    # Calculate the number of clusters
+    clusters_count = None
+    if hasattr(jukebox, 'clusters'):
+        if isinstance(jukebox.clusters, (list, tuple, set)):
+            clusters_count = len(jukebox.clusters)
+        elif isinstance(jukebox.clusters, int):
+            # If clusters is already an integer count, use it directly
+            clusters_count = jukebox.clusters
+
+    # Jukeboxes pickled before jump_points_count existed still need a count
+    jump_points_count = getattr(jukebox, 'jump_points_count', None)
+    if jump_points_count is None:
+        jump_points_count = sum(bool(beat.get('jump_candidates')) for beat in jukebox.beats)
+
+    return {
+        'duration': jukebox.duration,
+        'tempo': float(jukebox.tempo),
+        'beats': len(jukebox.beats),
+        'clusters': clusters_count,
+        'jump_points': jump_points_count,
+        'sample_rate': jukebox.sample_rate
+    }
+
+def process_song(file_path, original_filename):
+    """Run InfiniteJukebox on an uploaded song and write its caches to disk.
+
+    Runs in a worker process, so it only touches files and returns the song
+    metadata for the parent to record in the database.
+    """
+    # Load cached beats if available
+    beats_cache_filename = file_path + '_beats.npy'
+    cached_beats = np.array([])
+
+    try:
+        # memory-map the cache; InfiniteJukebox only reads from it
+        cached_beats = np.load(beats_cache_filename, mmap_mode='r', allow_pickle=False)
+        print(f"Loaded beat cache from {beats_cache_filename}")
+    except FileNotFoundError:
+        print(f"No beats cache file found: '{beats_cache_filename}'")
+    except Exception as e:
+        print(f"Warning: Error loading beat cache '{beats_cache_filename}': {e}")
+
+    print(f"Starting to process file with InfiniteJukebox...")
+
+    jukebox = InfiniteJukebox(
+        filename=file_path,
+        progress_callback=progress_callback,
+        do_async=False,
+        starting_beat_cache=cached_beats
+    )
+
+    # Check if beats were properly detected
+    if not hasattr(jukebox, 'beats') or len(jukebox.beats) == 0:
+        raise ValueError('No beats detected in the audio file')
+
+    # Save the jukebox object as a pickled file for future use
+    jukebox_pickled_filename = file_path + '_jukebox.pkl'
+    try:
+        cache_path = save_jukebox(jukebox, jukebox_pickled_filename)
+        print(f"Successfully saved compressed pickled jukebox to {cache_path}")
+    except Exception as e:
+        print(f"Warning: Error saving compressed pickled jukebox '{jukebox_pickled_filename}': {e}")
+
+    try:
+        save_segments_cache(file_path, build_segments_payload(jukebox, original_filename))
+    except Exception as e:
+        print(f"Warning: Error saving segments cache for '{file_path}': {e}")
+
+    try:
+        save_beats_table(file_path, jukebox)
+    except Exception as e:
+        print(f"Warning: Error saving beats table for '{file_path}': {e}")
+
+    print(f"Successfully processed song {original_filename}. Found {len(jukebox.beats)} beats.")
+
+    return summarize_jukebox(jukebox)
+
+def submit_song_processing(song_id, original_filename, encoded_filename, file_path, mime):
+    """Queue a song for background processing unless it is already in flight"""
+    with pending_jobs_lock:
+        if song_id in pending_jobs:
+            return
+
+        queue_song_write(
+            song_id=song_id,
+            original_filename=original_filename,
+            encoded_filename=encoded_filename,
+            file_path=file_path,
+            mime=mime,
+            status=song_mapper.STATUS_PENDING
+        )
+
+        future = executor.submit(process_song, file_path, original_filename)
+        pending_jobs[song_id] = future
+
+    def on_done(f):
+        try:
+            summary = f.result()
+            queue_song_write(
                 song_id=song_id,
                 original_filename=original_filename,
                 encoded_filename=encoded_filename,
                 file_path=file_path,
-                duration=jukebox.duration,
-                tempo=float(jukebox.tempo),
-                beats=len(jukebox.beats),
-                clusters=clusters_count,
-                jump_points=jump_points_count,
-                sample_rate=jukebox.sample_rate
+                mime=mime,
+                status=song_mapper.STATUS_DONE,
+                **summary
             )
-            
-            return jsonify({
-                'filename': original_filename,
-                'song_id': song_id,
-                'segments': segments,
-                'duration': jukebox.duration,
-                'tempo': float(jukebox.tempo),
-                'sample_rate': jukebox.sample_rate
-            })
+        except Exception as e:
+            print(f"Error in InfiniteJukebox processing: {str(e)}")
+            print(''.join(traceback.format_exception(type(e), e, e.__traceback__)))
+            queue_song_write(
+                song_id=song_id,
+                original_filename=original_filename,
+                encoded_filename=encoded_filename,
+                file_path=file_path,
+                mime=mime,
+                status=song_mapper.STATUS_ERROR
+            )
+        finally:
+            with pending_jobs_lock:
+                pending_jobs.pop(song_id, None)
 
-    except Exception as e:
-        print(f"Unexpected error in upload_file: {str(e)}")
-        print(traceback.format_exc())
-        return jsonify({'error': f'Unexpected error: {str(e)}'}), 500
-    
-    return jsonify({'error': 'Failed to process file'}), 500
+    future.add_done_callback(on_done)
 
 @app.route('/segments/<song_id>', methods=['GET'])
 def get_segments(song_id):
+    # A song's segments never change for a given song_id, so a matching ETag (of either
+    # encoding) needs no work at all
+    if song_id + ZSTD_ETAG_SUFFIX in request.if_none_match:
+        return with_song_etag(app.response_class(status=304), song_id, zstd_encoded=True)
+    if song_id in request.if_none_match:
+        return with_song_etag(app.response_class(status=304), song_id)
+
     # First check if the song is in memory
-    if song_id in processed_songs:
-        return jsonify(processed_songs[song_id])
+    with processed_songs_lock:
+        payload = processed_songs.get(song_id)
+    if payload is not None:
+        return with_song_etag(ojson(payload), song_id)
     
     # If not in memory, try to load from database
-    song = song_db.get_song(song_id)
+    song = lookup_song(song_id)
     if song is None:
         return jsonify({'error': 'Song not found in database'}), 404
     
+    if song.status == song_mapper.STATUS_PENDING:
+        return ojson({'song_id': song_id, 'status': song_mapper.STATUS_PENDING}, status=202)
+
     # Get the file path from the database
-    file_path = song['file_path']
-    original_filename = song['original_filename']
-    
-    # Try to load the pickled jukebox file
-    jukebox_pickled_filename = file_path + '_jukebox.pkl'
-    jukebox = None
-    
+    file_path = song.file_path
+    original_filename = song.original_filename
+
+    # Serve the pre-serialized payload if we have one, still compressed when the client accepts zstd
     try:
-        with gzip.open(jukebox_pickled_filename + '.gz', 'rb') as f:
-            jukebox = pickle.load(f)
-        print(f"Loaded compressed pickled jukebox for song {original_filename} from {jukebox_pickled_filename}.gz")
+        if 'zstd' in request.accept_encodings:
+            response = send_file(file_path + SEGMENTS_CACHE_SUFFIX, mimetype='application/json',
+                                 etag=song_id + ZSTD_ETAG_SUFFIX, conditional=True)
+            response.headers['Content-Encoding'] = 'zstd'
+            return with_song_etag(response, song_id, zstd_encoded=True)
+        return with_song_etag(
+            app.response_class(load_segments_cache(file_path), mimetype='application/json'), song_id)
     except FileNotFoundError:
-        print(f"No compressed pickled jukebox file found: '{jukebox_pickled_filename}.gz'")
-        return jsonify({'error': 'Song data not found'}), 404
+        print(f"No segments cache found for song {original_filename}, falling back to beats table")
     except Exception as e:
-        print(f"Error loading compressed pickled jukebox '{jukebox_pickled_filename}.gz': {e}")
-        return jsonify({'error': f'Error loading song data: {str(e)}'}), 500
-    
-    if jukebox is None:
-        return jsonify({'error': 'Failed to load song data'}), 500
-    
-    # Convert beats to a serializable format
-    segments = []
-    for beat in jukebox.beats:
-        beat_copy = beat.copy()
-        segments.append(beat_copy)
+        print(f"Warning: Error loading segments cache for '{file_path}': {e}")
+
+    # Next try the columnar beats table
+    payload = None
+    try:
+        payload = load_beats_table(file_path, original_filename)
+    except FileNotFoundError:
+        print(f"No beats table found for song {original_filename}, falling back to pickled jukebox")
+    except Exception as e:
+        print(f"Warning: Error loading beats table for '{file_path}': {e}")
+
+    if payload is None:
+        # Try to load the pickled jukebox file
+        jukebox_pickled_filename = file_path + '_jukebox.pkl'
+        jukebox = None
+        
+        try:
+            jukebox, cache_path = load_jukebox(jukebox_pickled_filename)
+            print(f"Loaded compressed pickled jukebox for song {original_filename} from {cache_path}")
+        except FileNotFoundError:
+            print(f"No compressed pickled jukebox file found: '{jukebox_pickled_filename}'")
+            return jsonify({'error': 'Song data not found'}), 404
+        except Exception as e:
+            print(f"Error loading compressed pickled jukebox '{jukebox_pickled_filename}': {e}")
+            return jsonify({'error': f'Error loading song data: {str(e)}'}), 500
+        
+        if jukebox is None:
+            return jsonify({'error': 'Failed to load song data'}), 500
+        
+        payload = build_segments_payload(jukebox, original_filename)
+
+        try:
+            save_beats_table(file_path, jukebox)
+        except Exception as e:
+            print(f"Warning: Error saving beats table for '{file_path}': {e}")
     
     # Store the processed data in memory for future requests
-    processed_songs[song_id] = {
-        'filename': original_filename,
-        'segments': segments,
-        'duration': jukebox.duration,
-        'tempo': float(jukebox.tempo),
-        'sample_rate': jukebox.sample_rate
-    }
+    with processed_songs_lock:
+        processed_songs[song_id] = payload
+
+    try:
+        save_segments_cache(file_path, payload)
+    except Exception as e:
+        print(f"Warning: Error saving segments cache for '{file_path}': {e}")
     
-    return jsonify(processed_songs[song_id])
+    return with_song_etag(ojson(payload), song_id)
 
 @app.route('/uploads/<song_id>', methods=['GET'])
 def get_upload(song_id):
     """Serve the uploaded audio file for a given song_id"""
     # Get the song from the database
-    song = song_db.get_song(song_id)
+    song = lookup_song(song_id)
     if song is None:
         return jsonify({'error': 'Song not found in database'}), 404
     
     # Get the file path from the database
-    file_path = song['file_path']
+    file_path = song.file_path
     
     # Check if the file exists
     if not os.path.exists(file_path):
         return jsonify({'error': 'Audio file not found on server'}), 404
     
-    # Determine the file type (you might want to store this in the database)
-    file_type = 'audio/mpeg'  # Default to MP3
-    if file_path.lower().endswith('.wav'):
-        file_type = 'audio/wav'
-    elif file_path.lower().endswith('.ogg'):
-        file_type = 'audio/ogg'
-    elif file_path.lower().endswith('.flac'):
-        file_type = 'audio/flac'
+    # Use the file type recorded at upload time, falling back to the file extension
+    file_type = song.mime or guess_audio_mimetype(file_path)
     
+    if app.config['USE_X_ACCEL_REDIRECT']:
+        # Hand the transfer off to the reverse proxy
+        response = app.response_class(status=200, mimetype=file_type)
+        response.headers['X-Accel-Redirect'] = app.config['X_ACCEL_REDIRECT_PREFIX'] + os.path.basename(file_path)
+        return response
+
     # Return the file
     return send_file(file_path, mimetype=file_type)
 
@@ -317,7 +802,7 @@ def health_check():
 @app.route('/filename_test/<encoded_filename>', methods=['GET'])
 def test_filename_decoding(encoded_filename):
     """Test endpoint to verify filename encoding/decoding works correctly"""
-    original = decode_filename(encoded_filename)
+    original = song_mapper.SongMapper.decode_filename(encoded_filename)
     return jsonify({
         'encoded': encoded_filename,
         'decoded': original
@@ -325,7 +810,7 @@ def test_filename_decoding(encoded_filename):
 
 @app.route('/songs', methods=['GET'])
 def get_songs():
-    """Get all songs from the database"""
+    """Get all processed songs from the database"""
     songs = song_db.get_all_songs()
     return jsonify({
         'songs': songs
@@ -334,14 +819,14 @@ def get_songs():
 @app.route('/songs/<song_id>', methods=['GET'])
 def get_song(song_id):
     """Get a specific song from the database"""
-    song = song_db.get_song(song_id)
+    song = lookup_song(song_id)
     if song is None:
         return jsonify({'error': 'Song not found'}), 404
-    return jsonify(song)
+    return jsonify(song._asdict())
 
 @app.route('/songs/search', methods=['GET'])
 def search_songs():
-    """Search for songs in the database"""
+    """Search for processed songs in the database"""
     query = request.args.get('q', '')
     songs = song_db.search_songs(query)
     return jsonify({
@@ -350,4 +835,5 @@ def search_songs():
     })
 
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=5001)
\ No newline at end of file
+    # Development server only; production runs under gunicorn (see gunicorn.conf.py)
+    app.run(debug=os.environ.get('FLASK_DEBUG', '').lower() in ('1', 'true', 'yes'), host='0.0.0.0', port=5001)
\ No newline at end of file
@@ -0,0 +1,26 @@
+"""Gunicorn settings for serving the Infinite Worship backend in production."""
+import os
+
+bind = '0.0.0.0:5001'
+
+# Threaded workers overlap the file I/O in /uploads and /segments. Song processing itself
+# runs in each worker's ProcessPoolExecutor, so split the cores between those pools.
+workers = int(os.environ.get('WEB_CONCURRENCY', os.cpu_count()))
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+os.environ.setdefault('JUKEBOX_WORKERS', str(max(1, os.cpu_count() // workers)))
+
+# Uploads of uncached songs can be slow to read and hash; also give a recycled worker
+# time to finish the songs it is still processing
+timeout = 600
+graceful_timeout = 600
+
+# Recycle workers periodically to bound the memory held in processed_songs
+max_requests = 1000
+max_requests_jitter = 100
+
+
+def worker_exit(server, worker):
+    """Let in-flight song processing and queued database writes finish before the worker exits"""
+    from app import drain_background_work
+    drain_background_work()
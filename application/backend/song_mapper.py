@@ -1,10 +1,42 @@
 import os
 import sqlite3
-import base64
+import binascii
+import collections
 import json
 import time
+import threading
+import functools
+import logging
 from datetime import datetime
 
+logger = logging.getLogger(__name__)
+
+# Translation tables between the standard and URL-safe base64 alphabets
+_B64_TO_URLSAFE = bytes.maketrans(b'+/', b'-_')
+_B64_FROM_URLSAFE = bytes.maketrans(b'-_', b'+/')
+
+def b64url_encode(text):
+    """URL-safe base64 encode a string, calling binascii directly instead of going through base64"""
+    return binascii.b2a_base64(text.encode('utf-8'), newline=False).translate(_B64_TO_URLSAFE).decode('ascii')
+
+def b64url_decode(encoded):
+    """Inverse of b64url_encode. Missing '=' padding is tolerated."""
+    data = encoded.encode('ascii').translate(_B64_FROM_URLSAFE)
+    return binascii.a2b_base64(data + b'=' * (-len(data) % 4)).decode('utf-8')
+
+# Processing states of a song. Uploads are recorded as PENDING while InfiniteJukebox
+# runs in the background and flip to DONE (or ERROR) when it finishes.
+STATUS_PENDING = 'PENDING'
+STATUS_DONE = 'DONE'
+STATUS_ERROR = 'ERROR'
+
+# Columns written by SongMapper inserts, in the order of the tuples bulk_add_songs accepts
+SONG_COLUMNS = ('song_id', 'original_filename', 'encoded_filename', 'file_path', 'duration', 'tempo',
+                'beats', 'clusters', 'jump_points', 'sample_rate', 'status', 'mime')
+
+# Rows returned by get_song_tuple: the inserted columns plus the timestamps SQLite maintains
+SongRow = collections.namedtuple('SongRow', SONG_COLUMNS + ('created_at', 'updated_at'))
+
 class SongMapper:
     """
     SongMapper class for managing song metadata in a SQLite database.
@@ -15,13 +47,37 @@ class SongMapper:
     - Decode base64 encoded filenames
     """
     
-    def __init__(self, db_path=None):
+    # The statements are kept as constants so each one is compiled once and then reused
+    # from the connection's statement cache
+    _SQL_INSERT = (
+        'INSERT OR REPLACE INTO songs (' + ', '.join(SONG_COLUMNS) + ', updated_at) '
+        'VALUES (' + ', '.join('?' * len(SONG_COLUMNS)) + ', CURRENT_TIMESTAMP)'
+    )
+    _SQL_GET = 'SELECT * FROM songs WHERE song_id = ?'
+    _SQL_GET_TUPLE = 'SELECT ' + ', '.join(SongRow._fields) + ' FROM songs WHERE song_id = ?'
+    # Listings and searches only return songs that finished processing, so the library
+    # never offers a PENDING or ERROR song that has no segments to load
+    _SQL_ALL = f"SELECT * FROM songs WHERE status = '{STATUS_DONE}' ORDER BY original_filename COLLATE NOCASE"
+    _SQL_SEARCH = (f"SELECT * FROM songs WHERE status = '{STATUS_DONE}' AND original_filename LIKE ? "
+                   "ORDER BY original_filename COLLATE NOCASE")
+    _SQL_SEARCH_FTS = f'''
+    SELECT s.* FROM songs_fts f JOIN songs s ON s.rowid = f.rowid
+    WHERE songs_fts MATCH ? AND s.status = '{STATUS_DONE}' ORDER BY s.original_filename COLLATE NOCASE
+    '''
+    _SQL_DELETE = 'DELETE FROM songs WHERE song_id = ?'
+    _SQL_TOUCH = f"UPDATE songs SET updated_at = CURRENT_TIMESTAMP WHERE song_id = ? AND status = '{STATUS_PENDING}'"
+    
+    def __init__(self, db_path=None, in_memory=False):
         """
         Initialize the SongMapper with a database path.
 
         Args:
             db_path (str, optional): Path to the SQLite database file.
                 If None, a default path will be used.
+            in_memory (bool, optional): Serve the database from memory, loading it from
+                db_path at startup. Writes only reach db_path when flush() is called, so
+                the caller must flush periodically and before exiting. Only safe when a
+                single process uses the database.
         """
         if db_path is None:
             # Use a default path in the uploads directory
@@ -31,11 +87,68 @@ class SongMapper:
             db_path = os.path.join(uploads_dir, 'songs.db')
 
         self.db_path = db_path
+
+        # One long-lived connection keeps SQLite's page cache warm between calls. It is
+        # shared by the request threads, so every use goes through self._lock.
+        self._lock = threading.Lock()
+        self._in_memory = in_memory
+        self._dirty = False
+        if in_memory:
+            self._conn = sqlite3.connect(':memory:', check_same_thread=False, cached_statements=128)
+            if os.path.exists(self.db_path):
+                disk = sqlite3.connect(self.db_path)
+                disk.backup(self._conn)
+                disk.close()
+        else:
+            self._conn = sqlite3.connect(self.db_path, check_same_thread=False, cached_statements=128)
+        self._conn.row_factory = sqlite3.Row  # This enables column access by name
+
+        # WAL lets the frequent reads run alongside the occasional write, and with it
+        # synchronous=NORMAL only syncs at checkpoints instead of on every commit
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('PRAGMA temp_store=MEMORY')
+        self._conn.execute('PRAGMA mmap_size=268435456')
+        self._conn.execute('PRAGMA cache_size=-20000')
+        # INSERT OR REPLACE only fires the delete trigger that keeps songs_fts in sync with this on
+        self._conn.execute('PRAGMA recursive_triggers=ON')
         self._init_db()
+        with self._lock:
+            self._persist()
+        self.flush()
+    
+    def _persist(self):
+        """Mark an in-memory database as needing a flush. Call with self._lock held."""
+        if self._in_memory:
+            self._dirty = True
+
+    def flush(self):
+        """
+        Back an in-memory database up to db_path if it changed since the last flush.
+        A backup copies the whole database, so writes are batched up between flushes
+        instead of each paying for one.
+        """
+        with self._lock:
+            if not self._dirty:
+                return
+            disk = sqlite3.connect(self.db_path)
+            try:
+                self._conn.backup(disk)
+                self._dirty = False
+            finally:
+                disk.close()
+    
+    def close(self):
+        """Close the database connection, refreshing query planner statistics first."""
+        self.flush()
+        with self._lock:
+            self._conn.execute('PRAGMA analysis_limit=400')
+            self._conn.execute('PRAGMA optimize')
+            self._conn.close()
     
     def _init_db(self):
         """Initialize the SQLite database with the required schema."""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._conn
         cursor = conn.cursor()
         
         # Create songs table if it doesn't exist
@@ -51,16 +164,65 @@ class SongMapper:
             clusters INTEGER,
             jump_points INTEGER,
             sample_rate INTEGER,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            status TEXT DEFAULT 'DONE',
+            mime TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP
         )
         ''')
+
+        # Add columns introduced after the table was first created
+        cursor.execute('PRAGMA table_info(songs)')
+        columns = {row[1] for row in cursor.fetchall()}
+        if 'status' not in columns:
+            cursor.execute("ALTER TABLE songs ADD COLUMN status TEXT DEFAULT 'DONE'")
+        if 'mime' not in columns:
+            cursor.execute('ALTER TABLE songs ADD COLUMN mime TEXT')
+        if 'updated_at' not in columns:
+            cursor.execute('ALTER TABLE songs ADD COLUMN updated_at TIMESTAMP')
+
+        # Lets the filename-ordered listings walk the index instead of sorting every call
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_songs_filename ON songs(original_filename COLLATE NOCASE)')
+
+        # Full-text index over the filenames for search_songs. The trigram tokenizer matches
+        # any substring of 3+ characters, including Chinese titles that have no word breaks.
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'songs_fts'")
+        fts_exists = cursor.fetchone() is not None
+        try:
+            cursor.executescript('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS songs_fts USING fts5(
+                song_id UNINDEXED, original_filename,
+                content='songs', content_rowid='rowid', tokenize='trigram'
+            );
+            CREATE TRIGGER IF NOT EXISTS songs_fts_insert AFTER INSERT ON songs BEGIN
+                INSERT INTO songs_fts(rowid, song_id, original_filename)
+                VALUES (new.rowid, new.song_id, new.original_filename);
+            END;
+            CREATE TRIGGER IF NOT EXISTS songs_fts_delete AFTER DELETE ON songs BEGIN
+                INSERT INTO songs_fts(songs_fts, rowid, song_id, original_filename)
+                VALUES ('delete', old.rowid, old.song_id, old.original_filename);
+            END;
+            CREATE TRIGGER IF NOT EXISTS songs_fts_update AFTER UPDATE ON songs BEGIN
+                INSERT INTO songs_fts(songs_fts, rowid, song_id, original_filename)
+                VALUES ('delete', old.rowid, old.song_id, old.original_filename);
+                INSERT INTO songs_fts(rowid, song_id, original_filename)
+                VALUES (new.rowid, new.song_id, new.original_filename);
+            END;
+            ''')
+            if not fts_exists:
+                # Index the songs that were added before the index existed
+                cursor.execute("INSERT INTO songs_fts(songs_fts) VALUES ('rebuild')")
+            self._fts = True
+        except sqlite3.OperationalError as e:
+            # SQLite builds without FTS5 (or older than 3.34) fall back to LIKE scans
+            logger.warning("Full-text search unavailable, falling back to LIKE: %s", e)
+            self._fts = False
         
         conn.commit()
-        conn.close()
     
     def add_song(self, song_id, original_filename, encoded_filename, file_path, 
                  duration=None, tempo=None, beats=None, clusters=None, 
-                 jump_points=None, sample_rate=None):
+                 jump_points=None, sample_rate=None, status=STATUS_DONE, mime=None):
         """
         Add a song to the database.
         
@@ -75,38 +237,101 @@ class SongMapper:
             clusters (int, optional): Number of clusters in the song
             jump_points (int, optional): Number of jump points in the song
             sample_rate (int, optional): Sample rate of the song
+            status (str, optional): Processing status of the song
+            mime (str, optional): Mimetype of the audio file
             
         Returns:
             bool: True if the song was added successfully, False otherwise
         """
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
+            with self._lock:
+                with self._conn as conn:
+                    conn.execute(self._SQL_INSERT, (
+                        song_id, 
+                        original_filename, 
+                        encoded_filename, 
+                        file_path, 
+                        duration, 
+                        tempo, 
+                        beats, 
+                        clusters, 
+                        jump_points,
+                        sample_rate,
+                        status,
+                        mime
+                    ))
+                self._persist()
             
-            cursor.execute('''
-            INSERT OR REPLACE INTO songs 
-            (song_id, original_filename, encoded_filename, file_path, 
-             duration, tempo, beats, clusters, jump_points, sample_rate)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                song_id, 
-                original_filename, 
-                encoded_filename, 
-                file_path, 
-                duration, 
-                tempo, 
-                beats, 
-                clusters, 
-                jump_points,
-                sample_rate
-            ))
+            logger.info("Successfully saved Song `%s` with SongID `%s` to database", original_filename, song_id)
+            return True
+        except sqlite3.Error:
+            logger.exception("Error adding song %s to database", song_id)
+            return False
+    
+    def bulk_add_songs(self, songs):
+        """
+        Add several songs to the database in a single transaction.
+        
+        Args:
+            songs (list): List of dicts holding the keyword arguments of add_song, or of
+                tuples already in SONG_COLUMNS order
             
-            conn.commit()
-            conn.close()
-            print(f"Successfully saved Song `{original_filename}` with SongID `{song_id}` to database")
+        Returns:
+            bool: True if the songs were added successfully, False otherwise
+        """
+        # rows are produced lazily so executemany never needs a second copy of the batch
+        rows = (song if isinstance(song, tuple) else self._song_row(song) for song in songs)
+
+        try:
+            # the connection context manager wraps all inserts in one BEGIN/COMMIT
+            with self._lock:
+                with self._conn as conn:
+                    conn.executemany(self._SQL_INSERT, rows)
+                self._persist()
+            
+            logger.info("Successfully saved %d songs to database", len(songs))
             return True
-        except Exception as e:
-            print(f"Error adding song to database: {str(e)}")
+        except sqlite3.Error:
+            logger.exception("Error adding songs to database")
+            return False
+    
+    @staticmethod
+    def _song_row(song):
+        """Convert add_song keyword arguments to an insert tuple in SONG_COLUMNS order."""
+        return (
+            song['song_id'],
+            song['original_filename'],
+            song['encoded_filename'],
+            song['file_path'],
+            song.get('duration'),
+            song.get('tempo'),
+            song.get('beats'),
+            song.get('clusters'),
+            song.get('jump_points'),
+            song.get('sample_rate'),
+            song.get('status', STATUS_DONE),
+            song.get('mime')
+        )
+    
+    def touch_songs(self, song_ids):
+        """
+        Refresh updated_at on songs that are still PENDING, as a heartbeat showing that
+        the process processing them is alive.
+        
+        Args:
+            song_ids (list): Song ids to touch
+            
+        Returns:
+            bool: True if the songs were touched successfully, False otherwise
+        """
+        try:
+            with self._lock:
+                with self._conn as conn:
+                    conn.executemany(self._SQL_TOUCH, ((song_id,) for song_id in song_ids))
+                self._persist()
+            return True
+        except sqlite3.Error:
+            logger.exception("Error touching %d pending songs", len(song_ids))
             return False
     
     def get_song(self, song_id):
@@ -118,74 +343,84 @@ class SongMapper:
             
         Returns:
             dict: Song data or None if not found
-        """
-        try:
-            conn = sqlite3.connect(self.db_path)
-            conn.row_factory = sqlite3.Row  # This enables column access by name
-            cursor = conn.cursor()
             
-            cursor.execute('SELECT * FROM songs WHERE song_id = ?', (song_id,))
-            row = cursor.fetchone()
+        Raises:
+            sqlite3.Error: If the query fails
+        """
+        with self._lock:
+            row = self._conn.execute(self._SQL_GET, (song_id,)).fetchone()
+        
+        if row:
+            return dict(row)
+        return None
+    
+    def get_song_tuple(self, song_id):
+        """
+        Get a song from the database by its ID as a SongRow namedtuple, for the hot internal
+        read paths that don't need the dict built by get_song.
+        
+        Args:
+            song_id (str): Unique identifier for the song
             
-            conn.close()
+        Returns:
+            SongRow: The song's row, or None if not found
             
-            if row:
-                return dict(row)
-            return None
-        except Exception as e:
-            print(f"Error getting song from database: {str(e)}")
-            return None
+        Raises:
+            sqlite3.Error: If the query fails
+        """
+        with self._lock:
+            cursor = self._conn.cursor()
+            cursor.row_factory = None
+            row = cursor.execute(self._SQL_GET_TUPLE, (song_id,)).fetchone()
+        return None if row is None else SongRow._make(row)
+    
+    def _fetch_dicts(self, sql, params=()):
+        """
+        Run a query and return its rows as dicts. Call with self._lock held.
+        
+        Rows are fetched as plain tuples and zipped with the column names read once from
+        cursor.description, skipping the sqlite3.Row built for every row.
+        """
+        cursor = self._conn.cursor()
+        cursor.row_factory = None
+        cursor.execute(sql, params)
+        columns = [d[0] for d in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor.fetchall()]
     
     def get_all_songs(self):
         """
-        Get all songs from the database.
+        Get all fully processed (DONE) songs from the database.
         
         Returns:
             list: List of song dictionaries
-        """
-        try:
-            conn = sqlite3.connect(self.db_path)
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            
-            cursor.execute('SELECT * FROM songs ORDER BY original_filename')
-            rows = cursor.fetchall()
             
-            conn.close()
-            
-            return [dict(row) for row in rows]
-        except Exception as e:
-            print(f"Error getting all songs from database: {str(e)}")
-            return []
+        Raises:
+            sqlite3.Error: If the query fails
+        """
+        with self._lock:
+            return self._fetch_dicts(self._SQL_ALL)
     
     def search_songs(self, query):
         """
-        Search for songs in the database.
+        Search for fully processed (DONE) songs in the database, ordered by filename
+        like get_all_songs regardless of the query length.
         
         Args:
             query (str): Search query
             
         Returns:
             list: List of matching song dictionaries
-        """
-        try:
-            conn = sqlite3.connect(self.db_path)
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
             
-            # Search in original_filename
-            cursor.execute(
-                'SELECT * FROM songs WHERE original_filename LIKE ? ORDER BY original_filename',
-                (f'%{query}%',)
-            )
-            rows = cursor.fetchall()
-            
-            conn.close()
-            
-            return [dict(row) for row in rows]
-        except Exception as e:
-            print(f"Error searching songs in database: {str(e)}")
-            return []
+        Raises:
+            sqlite3.Error: If the query fails
+        """
+        # Search in original_filename. Trigrams need at least 3 characters, so shorter
+        # queries still scan with LIKE.
+        with self._lock:
+            if self._fts and len(query) >= 3:
+                phrase = '"' + query.replace('"', '""') + '"'
+                return self._fetch_dicts(self._SQL_SEARCH_FTS, (phrase,))
+            return self._fetch_dicts(self._SQL_SEARCH, (f'%{query}%',))
     
     def delete_song(self, song_id):
         """
@@ -198,19 +433,19 @@ class SongMapper:
             bool: True if the song was deleted successfully, False otherwise
         """
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            cursor.execute('DELETE FROM songs WHERE song_id = ?', (song_id,))
+            with self._lock:
+                with self._conn as conn:
+                    conn.execute(self._SQL_DELETE, (song_id,))
+                self._persist()
             
-            conn.commit()
-            conn.close()
             return True
-        except Exception as e:
-            print(f"Error deleting song from database: {str(e)}")
+        except sqlite3.Error:
+            logger.exception("Error deleting song %s from database", song_id)
             return False
     
+    # Decoding is pure and the same few filenames come up again and again
     @staticmethod
+    @functools.lru_cache(maxsize=4096)
     def decode_filename(encoded_filename):
         """
         Decode a base64 encoded filename back to its original form.
@@ -224,10 +459,11 @@ class SongMapper:
         try:
             # Extract the encoded part (before the hash)
             encoded_part = encoded_filename.split('_')[0]
-            original = base64.urlsafe_b64decode(encoded_part.encode('ascii')).decode('utf-8')
+            original = b64url_decode(encoded_part)
             return original
-        except Exception as e:
-            print(f"Error decoding filename: {str(e)}")
+        except ValueError as e:
+            # binascii.Error and UnicodeDecodeError are both ValueErrors
+            logger.warning("Error decoding filename %s: %s", encoded_filename, e)
             return encoded_filename
     
     @staticmethod
@@ -242,28 +478,29 @@ class SongMapper:
             str: Base64 encoded filename
         """
         try:
-            encoded = base64.urlsafe_b64encode(original_filename.encode('utf-8')).decode('ascii')
+            encoded = b64url_encode(original_filename)
             return encoded
-        except Exception as e:
-            print(f"Error encoding filename: {str(e)}")
+        except UnicodeEncodeError as e:
+            logger.warning("Error encoding filename %s: %s", original_filename, e)
             return original_filename
 
 
 # Singleton instance for easy import
 _instance = None
 
-def get_instance(db_path=None):
+def get_instance(db_path=None, in_memory=False):
     """
     Get the singleton instance of SongMapper.
     
     Args:
         db_path (str, optional): Path to the SQLite database file.
             If None, a default path will be used.
+        in_memory (bool, optional): Serve the database from memory (see SongMapper)
             
     Returns:
         SongMapper: Singleton instance of SongMapper
     """
     global _instance
     if _instance is None:
-        _instance = SongMapper(db_path)
+        _instance = SongMapper(db_path, in_memory=in_memory)
     return _instance
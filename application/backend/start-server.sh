@@ -1,4 +1,7 @@
 #!/bin/bash
 
 echo "Starting Infinite Worship Backend Server..."
-python app.py 
\ No newline at end of file
+if [ -n "$FLASK_DEBUG" ]; then
+    exec python app.py
+fi
+exec gunicorn -c gunicorn.conf.py app:app
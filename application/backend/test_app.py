@@ -0,0 +1,226 @@
+import gzip
+import os
+import pickle
+import shutil
+import tempfile
+import types
+import unittest
+import numpy as np
+import orjson
+import zstandard as zstd
+import app
+import song_mapper
+
+class TestBeatsTable(unittest.TestCase):
+    def setUp(self):
+        """Set up a temp folder and a processed jukebox with two beats"""
+        self.tmp_dir = tempfile.mkdtemp()
+        self.file_path = os.path.join(self.tmp_dir, 'song')
+        self.beats = [
+            {'id': 0, 'start': 0.0, 'duration': np.float64(0.5), 'amplitude': 0.25, 'cluster': 2,
+             'segment': 0, 'is': 0, 'quartile': 0.0, 'next': 1, 'jump_candidates': [1]},
+            {'id': 1, 'start': 0.5, 'duration': np.float64(0.5), 'amplitude': 0.75, 'cluster': 2,
+             'segment': 0, 'is': 1, 'quartile': 2.0, 'next': 0, 'jump_candidates': []},
+        ]
+        self.jukebox = types.SimpleNamespace(beats=self.beats, duration=1.0, tempo=120.0, sample_rate=44100)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_round_trip(self):
+        """Test that load_beats_table rebuilds the payload saved by save_beats_table"""
+        app.save_beats_table(self.file_path, self.jukebox)
+        payload = app.load_beats_table(self.file_path, 'song.mp3')
+        self.assertEqual(payload, {
+            'filename': 'song.mp3',
+            'segments': [{k: float(v) if isinstance(v, np.floating) else v for k, v in b.items()}
+                         for b in self.beats],
+            'duration': 1.0,
+            'tempo': 120.0,
+            'sample_rate': 44100,
+        })
+
+    def test_extra_fields_are_dropped(self):
+        """Test that fields outside the schema, like a 2-D audio buffer, don't break the table"""
+        for beat in self.beats:
+            beat['buffer'] = np.zeros((4, 2), dtype=np.int16)
+        app.save_beats_table(self.file_path, self.jukebox)
+        segments = app.load_beats_table(self.file_path, 'song.mp3')['segments']
+        self.assertEqual([list(s) for s in segments], [list(app.BEATS_TABLE_SCHEMA.names)] * 2)
+
+    def test_missing_table(self):
+        """Test that a missing table raises FileNotFoundError so callers can fall back"""
+        with self.assertRaises(FileNotFoundError):
+            app.load_beats_table(self.file_path, 'song.mp3')
+
+
+class TestJukeboxCache(unittest.TestCase):
+    def setUp(self):
+        """Set up a temp folder and a jukebox-like object carrying NumPy arrays"""
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'song_jukebox.pkl')
+        self.jukebox = types.SimpleNamespace(
+            tempo=120.0,
+            raw_audio=np.arange(44100 * 2, dtype=np.int16).reshape(-1, 2),
+            beats=[{'id': 0, 'buffer': np.ones((8, 2), dtype=np.int16)}],
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def assertJukeboxEqual(self, loaded):
+        self.assertEqual(loaded.tempo, self.jukebox.tempo)
+        np.testing.assert_array_equal(loaded.raw_audio, self.jukebox.raw_audio)
+        np.testing.assert_array_equal(loaded.beats[0]['buffer'], self.jukebox.beats[0]['buffer'])
+
+    def test_round_trip(self):
+        """Test that load_jukebox reads back what save_jukebox wrote, arrays included"""
+        zst_path = app.save_jukebox(self.jukebox, self.path)
+        self.assertEqual(zst_path, self.path + '.zst')
+        loaded, cache_path = app.load_jukebox(self.path)
+        self.assertEqual(cache_path, zst_path)
+        self.assertJukeboxEqual(loaded)
+        # the arrays are loaded from writable buffers, so the jukebox can keep modifying them
+        self.assertTrue(loaded.raw_audio.flags.writeable)
+
+    def test_legacy_gzip_fallback(self):
+        """Test that a jukebox only cached as a legacy gzip pickle still loads"""
+        with gzip.open(self.path + '.gz', 'wb') as f:
+            pickle.dump(self.jukebox, f)
+        loaded, cache_path = app.load_jukebox(self.path)
+        self.assertEqual(cache_path, self.path + '.gz')
+        self.assertJukeboxEqual(loaded)
+
+    def test_unrecognized_format(self):
+        """Test that a zstd cache without the IWJB5 header is rejected"""
+        with open(self.path + '.zst', 'wb') as f:
+            f.write(zstd.compress(pickle.dumps(self.jukebox)))
+        with self.assertRaises(ValueError):
+            app.load_jukebox(self.path)
+
+    def test_truncated_cache(self):
+        """Test that a cache cut short raises EOFError instead of returning a partial jukebox"""
+        zst_path = app.save_jukebox(self.jukebox, self.path)
+        with open(zst_path, 'rb') as f:
+            raw = zstd.ZstdDecompressor().decompressobj().decompress(f.read())
+        with open(zst_path, 'wb') as f:
+            f.write(zstd.compress(raw[:len(raw) // 2]))
+        with self.assertRaises(EOFError):
+            app.load_jukebox(self.path)
+
+    def test_missing_cache(self):
+        """Test that a song without either cache raises FileNotFoundError"""
+        with self.assertRaises(FileNotFoundError):
+            app.load_jukebox(self.path)
+
+
+class TestCheckUploadLength(unittest.TestCase):
+    def setUp(self):
+        """Set up a Flask test client and an upload_raw URL"""
+        self.client = app.app.test_client()
+        self.url = '/upload_raw/' + song_mapper.b64url_encode('song.mp3')
+
+    def test_missing_content_length(self):
+        """Test that a body without a Content-Length is rejected with 411"""
+        response = self.client.put(self.url)
+        self.assertEqual(response.status_code, 411)
+
+    def test_empty_body(self):
+        """Test that an empty body is rejected with 400"""
+        response = self.client.put(self.url, data=b'', environ_overrides={'CONTENT_LENGTH': '0'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_oversized_body(self):
+        """Test that both upload routes reject a Content-Length over MAX_CONTENT_LENGTH with 413"""
+        too_long = str(app.app.config['MAX_CONTENT_LENGTH'] + 1)
+        for method, url in (('PUT', self.url), ('POST', '/upload')):
+            with self.subTest(url=url):
+                response = self.client.open(url, method=method, data=b'x',
+                                            environ_overrides={'CONTENT_LENGTH': too_long})
+                self.assertEqual(response.status_code, 413)
+
+
+class TestGetSegments(unittest.TestCase):
+    def setUp(self):
+        """Point the app at a temp database holding one DONE and one PENDING song"""
+        self.tmp_dir = tempfile.mkdtemp()
+        self.saved_song_db = app.song_db
+        app.song_db = song_mapper.SongMapper(os.path.join(self.tmp_dir, 'songs.db'))
+        self.clear_caches()
+        self.client = app.app.test_client()
+
+        self.song_id = song_mapper.b64url_encode('song.mp3') + '_' + 'ab' * 32
+        self.file_path = os.path.join(self.tmp_dir, self.song_id)
+        app.song_db.add_song(self.song_id, 'song.mp3', song_mapper.b64url_encode('song.mp3'), self.file_path)
+        app.song_db.add_song('pending', 'pending.mp3', 'cGVuZGluZy5tcDM=', '/tmp/pending.mp3',
+                             status=song_mapper.STATUS_PENDING)
+        self.jukebox = types.SimpleNamespace(duration=0.5, tempo=120.0, sample_rate=44100, beats=[
+            {'id': 0, 'start': 0.0, 'duration': 0.5, 'amplitude': 1.0, 'cluster': 0, 'segment': 0,
+             'is': 0, 'quartile': 0.0, 'next': 0, 'jump_candidates': []},
+        ])
+        self.payload = {'filename': 'song.mp3', 'segments': self.jukebox.beats,
+                        'duration': 0.5, 'tempo': 120.0, 'sample_rate': 44100}
+
+    def tearDown(self):
+        self.clear_caches()
+        app.song_db.close()
+        app.song_db = self.saved_song_db
+        shutil.rmtree(self.tmp_dir)
+
+    def clear_caches(self):
+        with app.song_cache_lock:
+            app.song_cache.clear()
+        with app.processed_songs_lock:
+            app.processed_songs.clear()
+
+    def get(self, song_id=None, **headers):
+        return self.client.get('/segments/' + (song_id or self.song_id), headers=headers)
+
+    def test_segments_cache_with_etag(self):
+        """Test that the segments cache is served with the song_id as ETag, and revalidates to 304"""
+        app.save_segments_cache(self.file_path, self.payload)
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_etag(), (self.song_id, False))
+        self.assertIn('Accept-Encoding', response.vary)
+        self.assertEqual(orjson.loads(response.data), self.payload)
+
+        response = self.get(**{'If-None-Match': f'"{self.song_id}"'})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.get_etag(), (self.song_id, False))
+
+    def test_zstd_encoded_segments(self):
+        """Test that clients accepting zstd get the cache file as is, under a separate ETag"""
+        app.save_segments_cache(self.file_path, self.payload)
+        response = self.get(**{'Accept-Encoding': 'gzip, zstd'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Content-Encoding'], 'zstd')
+        self.assertEqual(response.get_etag(), (self.song_id + app.ZSTD_ETAG_SUFFIX, False))
+        response.direct_passthrough = False
+        self.assertEqual(orjson.loads(zstd.decompress(response.get_data())), self.payload)
+        response.close()
+
+        response = self.get(**{'Accept-Encoding': 'zstd',
+                               'If-None-Match': f'"{self.song_id}{app.ZSTD_ETAG_SUFFIX}"'})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.get_etag(), (self.song_id + app.ZSTD_ETAG_SUFFIX, False))
+
+    def test_falls_back_to_beats_table(self):
+        """Test that a song without a segments cache is served from its beats table, which refills the cache"""
+        app.save_beats_table(self.file_path, self.jukebox)
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(orjson.loads(response.data), self.payload)
+        self.assertEqual(orjson.loads(app.load_segments_cache(self.file_path)), self.payload)
+
+    def test_pending_and_missing_songs(self):
+        """Test that a PENDING song answers 202 and unknown or data-less songs 404"""
+        response = self.get('pending')
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.json['status'], song_mapper.STATUS_PENDING)
+        self.assertEqual(self.get('missing').status_code, 404)
+        self.assertEqual(self.get().status_code, 404)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,21 @@
+import collections
+import importlib.util
+import os
+import sys
 import unittest
 import numpy as np
 from Remixatron import symmetrize_matrix
 
+# The play vector is only built by the exploration copy of Remixatron, which shares this
+# module name, so load it from its path under a name of its own
+EXPLORATION_REMIXATRON_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+    'exploration', 'remixatron', 'Remixatron.py')
+_spec = importlib.util.spec_from_file_location('exploration_remixatron', EXPLORATION_REMIXATRON_PATH)
+exploration_remixatron = importlib.util.module_from_spec(_spec)
+sys.modules[_spec.name] = exploration_remixatron
+_spec.loader.exec_module(exploration_remixatron)
+
 class TestMatrixSymmetrization(unittest.TestCase):
     def setUp(self):
         """Set up test matrices that will be used across multiple tests"""
@@ -38,5 +52,84 @@ class TestMatrixSymmetrization(unittest.TestCase):
             symmetrize_matrix(non_square)
 
 
+class TestPlayVectorKernel(unittest.TestCase):
+    def setUp(self):
+        """Build a small synthetic song: 16 segments of 4 beats played in order, looping at the end"""
+        self.beats_per_segment = 4
+        self.num_segments = 16
+        num_beats = self.beats_per_segment * self.num_segments
+        self.segment = (np.arange(num_beats) // self.beats_per_segment).astype(np.int32)
+        self.quartile = (np.arange(num_beats) * 4 // num_beats).astype(np.int32)
+        self.next_beat = ((np.arange(num_beats) + 1) % num_beats).astype(np.int32)
+
+        # every beat can jump to the beat in the same position of every other segment, so a
+        # candidate outside the recently played segments always exists and no jump falls back
+        self.jump_candidates = [
+            [c for c in range(b % self.beats_per_segment, num_beats, self.beats_per_segment) if c != b]
+            for b in range(num_beats)
+        ]
+        self.jc_offsets = np.zeros(num_beats + 1, dtype=np.int32)
+        np.cumsum([len(c) for c in self.jump_candidates], out=self.jc_offsets[1:])
+        self.jc_values = np.array([c for cs in self.jump_candidates for c in cs], dtype=np.int32)
+
+        self.recent_depth = 4
+        self.min_sequence = 16
+        self.max_sequence_len = 32
+        self.length = 5000
+
+    def build(self, seed):
+        # max_beats_between_jumps is out of reach, so jumps only happen at the end of a sequence
+        return exploration_remixatron._play_vector_kernel(
+            self.segment, self.quartile, self.next_beat, self.jc_values, self.jc_offsets,
+            0, self.recent_depth, self.num_segments, self.min_sequence, self.max_sequence_len,
+            self.length + 1, self.length, seed)
+
+    def test_play_vector_follows_jump_rules(self):
+        """Test that every step follows next or jumps to a non-recent candidate when its sequence ends"""
+        for seed in (0, 1, 2):
+            with self.subTest(seed=seed):
+                beat, seq_len, seq_pos = self.build(seed)
+
+                self.assertEqual(len(beat), self.length + 1)
+                self.assertEqual((beat[0], seq_len[0], seq_pos[0]), (0, self.min_sequence, 0))
+
+                recent = collections.deque(maxlen=self.recent_depth)
+                jumps = 0
+
+                for i in range(self.length):
+                    b = int(beat[i])
+                    if self.segment[b] not in recent:
+                        recent.append(self.segment[b])
+
+                    if seq_pos[i] + 1 == seq_len[i]:
+                        # the sequence is over: jump to a candidate outside the recent segments,
+                        # restarting the position at 0 with a new sequence length
+                        jumps += 1
+                        self.assertIn(beat[i + 1], self.jump_candidates[b], f"step {i}")
+                        self.assertNotIn(self.segment[beat[i + 1]], recent, f"step {i}")
+                        self.assertEqual(seq_pos[i + 1], 0, f"step {i}")
+                        self.assertIn(seq_len[i + 1], range(16, self.max_sequence_len, 4), f"step {i}")
+                    else:
+                        self.assertEqual(beat[i + 1], self.next_beat[b], f"step {i}")
+                        self.assertEqual(seq_pos[i + 1], seq_pos[i] + 1, f"step {i}")
+                        self.assertEqual(seq_len[i + 1], seq_len[i], f"step {i}")
+
+                self.assertGreater(jumps, self.length // self.max_sequence_len)
+
+    def test_play_vector_is_reproducible(self):
+        """Test that the same seed builds the same play vector"""
+        for a, b in zip(self.build(7), self.build(7)):
+            np.testing.assert_array_equal(a, b)
+
+    def test_play_vector_items(self):
+        """Test that PlayVector hands out the per-item dicts callers index and slice"""
+        play_vector = exploration_remixatron.PlayVector(*self.build(0))
+        self.assertEqual(len(play_vector), self.length + 1)
+        self.assertEqual(play_vector[0], {'beat': 0, 'seq_len': self.min_sequence, 'seq_pos': 0})
+        head = play_vector[0:10]
+        self.assertEqual(len(head), 10)
+        self.assertEqual([v['beat'] for v in head], list(range(10)))
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,205 @@
+import base64
+import binascii
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from song_mapper import STATUS_DONE, STATUS_ERROR, STATUS_PENDING, SongMapper, SongRow, b64url_encode, b64url_decode
+
+class TestBase64UrlFilenames(unittest.TestCase):
+    def setUp(self):
+        """Filenames covering ASCII, Chinese and other non-ASCII names"""
+        self.filenames = [
+            'Amazing Grace.mp3',
+            '奇异恩典.mp3',
+            '主祷文 (Live) - 赞美之泉.flac',
+            'Café del Mar – Ñandú.ogg',
+            '🎵 worship.wav',
+            'a',
+            'ab',
+            'abc',
+        ]
+
+    def test_round_trip(self):
+        """Test that b64url_decode inverts b64url_encode"""
+        for filename in self.filenames:
+            with self.subTest(filename=filename):
+                self.assertEqual(b64url_decode(b64url_encode(filename)), filename)
+
+    def test_matches_base64_urlsafe(self):
+        """Test that the encoding is the standard urlsafe base64 used for existing song_ids"""
+        for filename in self.filenames:
+            with self.subTest(filename=filename):
+                expected = base64.urlsafe_b64encode(filename.encode('utf-8')).decode('ascii')
+                self.assertEqual(b64url_encode(filename), expected)
+
+    def test_urlsafe_alphabet(self):
+        """Test that '-' and '_' are produced instead of '+' and '/', and decoded back"""
+        # '>>>' encodes to 'Pj4-' and '???' to 'Pz8_'
+        self.assertEqual(b64url_encode('>>>'), 'Pj4-')
+        self.assertEqual(b64url_encode('???'), 'Pz8_')
+        self.assertEqual(b64url_decode('Pj4-'), '>>>')
+        self.assertEqual(b64url_decode('Pz8_'), '???')
+        for filename in self.filenames:
+            with self.subTest(filename=filename):
+                encoded = b64url_encode(filename)
+                self.assertNotIn('+', encoded)
+                self.assertNotIn('/', encoded)
+
+    def test_padded_and_unpadded_input(self):
+        """Test that decoding tolerates missing '=' padding"""
+        for filename in self.filenames:
+            with self.subTest(filename=filename):
+                padded = b64url_encode(filename)
+                unpadded = padded.rstrip('=')
+                self.assertEqual(b64url_decode(padded), filename)
+                self.assertEqual(b64url_decode(unpadded), filename)
+
+    def test_invalid_input(self):
+        """Test that undecodable input raises ValueError"""
+        # not valid UTF-8 once decoded
+        with self.assertRaises(ValueError):
+            b64url_decode(base64.urlsafe_b64encode(b'\xff\xfe').decode('ascii'))
+        # a single leftover base64 character can't encode any bytes
+        with self.assertRaises(binascii.Error):
+            b64url_decode('SGVsbG8xx')
+
+
+class TestSongMapper(unittest.TestCase):
+    def setUp(self):
+        """Set up a SongMapper over a temp database file"""
+        self.tmp_dir = tempfile.mkdtemp()
+        self.mapper = SongMapper(os.path.join(self.tmp_dir, 'songs.db'))
+
+    def tearDown(self):
+        self.mapper.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def add(self, song_id, filename, status=STATUS_DONE):
+        return self.mapper.add_song(song_id, filename, b64url_encode(filename), '/tmp/' + filename,
+                                    duration=60.0, status=status, mime='audio/mpeg')
+
+    def search_ids(self, query):
+        return [s['song_id'] for s in self.mapper.search_songs(query)]
+
+    def test_replace_keeps_search_index_in_sync(self):
+        """Test that re-adding a song_id replaces its search entry instead of duplicating it"""
+        self.assertTrue(self.mapper._fts)
+        self.add('id1', 'Old Name.mp3', status=STATUS_PENDING)
+        self.add('id1', 'New Name.mp3')
+        self.add('id1', 'New Name.mp3')
+        self.assertEqual(self.search_ids('New Name'), ['id1'])
+        self.assertEqual(self.search_ids('Old Name'), [])
+        self.assertEqual(self.mapper.get_song('id1')['original_filename'], 'New Name.mp3')
+
+    def test_delete_removes_search_entry(self):
+        """Test that a deleted song no longer matches searches"""
+        self.add('id1', '奇异恩典.mp3')
+        self.assertEqual(self.search_ids('奇异恩'), ['id1'])
+        self.assertTrue(self.mapper.delete_song('id1'))
+        self.assertEqual(self.search_ids('奇异恩'), [])
+        self.assertIsNone(self.mapper.get_song('id1'))
+
+    def test_only_done_songs_are_listed(self):
+        """Test that listing and search skip PENDING and ERROR songs, which stay fetchable by id"""
+        self.add('done', 'Grace done.mp3')
+        self.add('pending', 'Grace pending.mp3', status=STATUS_PENDING)
+        self.add('error', 'Grace error.mp3', status=STATUS_ERROR)
+        self.assertEqual([s['song_id'] for s in self.mapper.get_all_songs()], ['done'])
+        for query in ('Grace', 'Gr'):
+            with self.subTest(query=query):
+                self.assertEqual(self.search_ids(query), ['done'])
+        self.assertEqual(self.mapper.get_song('pending')['status'], STATUS_PENDING)
+        self.assertEqual(self.mapper.get_song_tuple('error').status, STATUS_ERROR)
+
+    def test_bulk_add_dicts_and_tuples(self):
+        """Test that bulk_add_songs accepts add_song keyword dicts and SONG_COLUMNS tuples"""
+        self.assertTrue(self.mapper.bulk_add_songs([
+            {'song_id': 'id1', 'original_filename': 'a.mp3', 'encoded_filename': 'YS5tcDM=',
+             'file_path': '/tmp/a.mp3', 'tempo': 120.0},
+            ('id2', 'b.mp3', 'Yi5tcDM=', '/tmp/b.mp3', None, None, None, None, None, None,
+             STATUS_PENDING, 'audio/wav'),
+        ]))
+        first = self.mapper.get_song('id1')
+        self.assertEqual((first['tempo'], first['status'], first['mime']), (120.0, STATUS_DONE, None))
+        second = self.mapper.get_song('id2')
+        self.assertEqual((second['status'], second['mime']), (STATUS_PENDING, 'audio/wav'))
+
+    def test_get_song_tuple(self):
+        """Test that get_song_tuple returns the same row as get_song as a SongRow"""
+        self.add('id1', 'a.mp3')
+        song = self.mapper.get_song_tuple('id1')
+        self.assertIsInstance(song, SongRow)
+        self.assertEqual(song._asdict(), self.mapper.get_song('id1'))
+        self.assertIsNone(self.mapper.get_song_tuple('missing'))
+
+    def test_touch_songs_only_refreshes_pending(self):
+        """Test that touch_songs moves updated_at forward for PENDING songs only"""
+        self.add('pending', 'a.mp3', status=STATUS_PENDING)
+        self.add('done', 'b.mp3')
+        with self.mapper._conn as conn:
+            conn.execute("UPDATE songs SET updated_at = '2000-01-01 00:00:00'")
+        self.assertTrue(self.mapper.touch_songs(['pending', 'done', 'missing']))
+        self.assertGreater(self.mapper.get_song('pending')['updated_at'], '2000-01-01 00:00:00')
+        self.assertEqual(self.mapper.get_song('done')['updated_at'], '2000-01-01 00:00:00')
+
+
+class TestInMemorySongMapper(unittest.TestCase):
+    def setUp(self):
+        """Set up an in-memory SongMapper backed by a temp database file"""
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.tmp_dir, 'songs.db')
+        self.mapper = SongMapper(self.db_path, in_memory=True)
+
+    def tearDown(self):
+        self.mapper.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def count_on_disk(self):
+        conn = sqlite3.connect(self.db_path)
+        try:
+            return conn.execute('SELECT COUNT(*) FROM songs').fetchone()[0]
+        finally:
+            conn.close()
+
+    def test_writes_reach_disk_on_flush(self):
+        """Test that writes stay in memory until flush() backs them up"""
+        self.mapper.add_song('id1', 'a.mp3', 'YS5tcDM=', '/tmp/a.mp3', mime='audio/mpeg')
+        self.assertEqual(self.count_on_disk(), 0)
+        self.mapper.flush()
+        self.assertEqual(self.count_on_disk(), 1)
+
+    def test_reload_after_close(self):
+        """Test that close() flushes, and a new mapper loads the saved songs"""
+        self.mapper.add_song('id1', 'a.mp3', 'YS5tcDM=', '/tmp/a.mp3', mime='audio/mpeg')
+        self.mapper.close()
+        self.mapper = SongMapper(self.db_path, in_memory=True)
+        self.assertEqual(self.mapper.get_song('id1')['original_filename'], 'a.mp3')
+
+
+class TestSearchSongs(unittest.TestCase):
+    def setUp(self):
+        """Set up a temp database with songs whose filename order differs from insert order"""
+        self.tmp_dir = tempfile.mkdtemp()
+        self.mapper = SongMapper(os.path.join(self.tmp_dir, 'songs.db'))
+        for song_id, filename in (('id1', 'Zion Grace.mp3'), ('id2', 'amazing grace.mp3'),
+                                  ('id3', 'Grace Alone.mp3')):
+            self.mapper.add_song(song_id, filename, b64url_encode(filename), '/tmp/' + filename)
+
+    def tearDown(self):
+        self.mapper.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_short_and_long_queries_share_ordering(self):
+        """Test that FTS (3+ characters) and LIKE (shorter) results are both sorted by filename"""
+        expected = ['amazing grace.mp3', 'Grace Alone.mp3', 'Zion Grace.mp3']
+        for query in ('grace', 'gr', 'G'):
+            with self.subTest(query=query):
+                songs = self.mapper.search_songs(query)
+                self.assertEqual([s['original_filename'] for s in songs], expected)
+        self.assertEqual([s['original_filename'] for s in self.mapper.get_all_songs()], expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
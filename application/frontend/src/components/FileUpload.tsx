@@ -9,6 +9,33 @@ interface FileUploadProps {
   onUploadError: (message: string) => void;
 }
 
+// How often to check on a song that is still being processed in the background
+const PROCESSING_POLL_INTERVAL_MS = 2000;
+// Give up if a song is still pending after this long. The backend marks jobs it has lost
+// as ERROR on its own, so this is only a last resort for a song stuck in a long queue.
+const PROCESSING_TIMEOUT_MS = 60 * 60 * 1000;
+
+const waitForProcessing = async (songId: string) => {
+  // The backend answers uploads of new songs with 202 and processes them in the
+  // background. Poll the song record until it is done, then fetch its segments.
+  const deadline = Date.now() + PROCESSING_TIMEOUT_MS;
+  for (;;) {
+    if (Date.now() > deadline) {
+      throw new Error('Timed out waiting for the server to process this song.');
+    }
+    await new Promise((resolve) => setTimeout(resolve, PROCESSING_POLL_INTERVAL_MS));
+    const songResponse = await api.get(`/songs/${songId}`);
+    if (songResponse.data.status === 'ERROR') {
+      throw new Error('The server failed to process this song.');
+    }
+    if (songResponse.data.status !== 'PENDING') {
+      break;
+    }
+  }
+  const segmentsResponse = await api.get(`/segments/${songId}`);
+  return { ...segmentsResponse.data, song_id: songId };
+};
+
 const FileUpload: React.FC<FileUploadProps> = ({ onUploadSuccess, onUploadError }) => {
   const [file, setFile] = useState<File | null>(null);
   const [isUploading, setIsUploading] = useState(false);
@@ -28,16 +55,24 @@ const FileUpload: React.FC<FileUploadProps> = ({ onUploadSuccess, onUploadError
     setIsUploading(true);
     onUploadError('');
 
-    const formData = new FormData();
-    formData.append('file', file);
+    // Send the file as the raw request body; the original filename travels in the
+    // URL as urlsafe base64 so non-ASCII (e.g. Chinese) names are preserved.
+    const utf8Name = new TextEncoder().encode(file.name);
+    const encodedFilename = btoa(String.fromCharCode(...Array.from(utf8Name)))
+      .replace(/\+/g, '-')
+      .replace(/\//g, '_');
 
     try {
-      const response = await api.post('/upload', formData, {
+      const response = await api.put(`/upload_raw/${encodedFilename}`, file, {
         headers: {
-          'Content-Type': 'multipart/form-data',
+          'Content-Type': 'application/octet-stream',
         },
       });
-      onUploadSuccess(response.data);
+      if (response.status === 202) {
+        onUploadSuccess(await waitForProcessing(response.data.song_id));
+      } else {
+        onUploadSuccess(response.data);
+      }
     } catch (error) {
       let errorMessage = 'An unexpected error occurred.';
       if (axios.isAxiosError(error)) {
@@ -31,18 +31,332 @@ be signaled when the processing is complete. The default mode is to run synchron
 
 """
 
-import collections
+import concurrent.futures
+import joblib
 import librosa
 import madmom
-import math
+import os
 import random
 import scipy
+import scipy.sparse.linalg
 import threading
 
 import numpy as np
+import sklearn
 import sklearn.cluster
 import sklearn.metrics
 
+try:
+    import cuml
+    import cuml.cluster
+    import cuml.metrics.cluster
+    import cupy
+except ImportError:
+    cuml = None
+    cupy = None
+
+from numba import njit
+
+
+# Not cache=True: numba's on-disk cache is keyed by the source file but records the importing
+# module's name, so loading this file under another name (as the tests do) would poison the
+# cache for `import Remixatron`. Compiling takes about a second, once per process.
+@njit
+def _play_vector_kernel(segment, quartile, next_beat, jc_values, jc_offsets,
+                        loop_bounds_begin, recent_depth, num_segments,
+                        min_sequence, max_sequence_len, max_beats_between_jumps,
+                        length, seed):
+    """
+    Builds the play vector from flat per-beat arrays.
+
+    This is the play vector loop of InfiniteJukebox.__process_audio compiled
+    with numba. jump_candidates are passed CSR style: the candidates for beat
+    b are jc_values[jc_offsets[b]:jc_offsets[b + 1]].
+
+    Returns:
+        (beat, seq_len, seq_pos) int32 arrays of length + 1 entries
+    """
+
+    np.random.seed(seed)
+
+    num_beats = segment.shape[0]
+    num_seq_choices = (max_sequence_len - 16 + 3) // 4
+
+    out_beat = np.empty(length + 1, dtype=np.int32)
+    out_seq_len = np.empty(length + 1, dtype=np.int32)
+    out_seq_pos = np.empty(length + 1, dtype=np.int32)
+
+    current_sequence = 0
+    beat = 0
+
+    out_beat[0] = 0
+    out_seq_len[0] = min_sequence
+    out_seq_pos[0] = current_sequence
+
+    # ring buffer of recently played segments, plus a per-segment membership flag
+    recent = np.empty(recent_depth, dtype=np.int32)
+    in_recent = np.zeros(num_segments, dtype=np.bool_)
+    recent_head = 0
+    recent_count = 0
+
+    candidates = np.empty(jc_values.shape[0] + 1, dtype=np.int32)
+
+    beats_since_jump = 0
+    failed_jumps = 0
+
+    for i in range(length):
+
+        seg = segment[beat]
+
+        if not in_recent[seg]:
+            if recent_count == recent_depth:
+                in_recent[recent[recent_head]] = False
+            else:
+                recent_count += 1
+            recent[recent_head] = seg
+            in_recent[seg] = True
+            recent_head = (recent_head + 1) % recent_depth
+
+        current_sequence += 1
+
+        will_jump = (current_sequence == min_sequence) or (beats_since_jump >= max_beats_between_jumps)
+
+        if will_jump:
+
+            n_candidates = 0
+
+            for k in range(jc_offsets[beat], jc_offsets[beat + 1]):
+                c = jc_values[k]
+                if not in_recent[segment[c]]:
+                    candidates[n_candidates] = c
+                    n_candidates += 1
+
+            if n_candidates == 0:
+
+                beats_since_jump += 1
+                failed_jumps += 1
+
+                # the non-quartile candidate that is furthest from the current beat
+                jump_to = -1
+                furthest_distance = -1
+
+                for k in range(jc_offsets[beat], jc_offsets[beat + 1]):
+                    c = jc_values[k]
+                    if quartile[c] != quartile[beat] and abs(beat - c) > furthest_distance:
+                        furthest_distance = abs(beat - c)
+                        jump_to = c
+
+                if (failed_jumps >= (.1 * num_beats)) and (jump_to >= 0):
+                    beat = jump_to
+                    beats_since_jump = 0
+                    failed_jumps = 0
+
+                elif failed_jumps >= (.2 * num_beats):
+                    beats_since_jump = 0
+                    failed_jumps = 0
+                    beat = loop_bounds_begin
+
+                else:
+                    beat = next_beat[beat]
+
+            else:
+
+                beats_since_jump = 0
+                failed_jumps = 0
+                beat = candidates[np.random.randint(0, n_candidates)]
+
+            current_sequence = 0
+            min_sequence = 16 + 4 * np.random.randint(0, num_seq_choices)
+
+            if beats_since_jump >= max_beats_between_jumps:
+                current_sequence = min_sequence
+
+            out_beat[i + 1] = beat
+            out_seq_len[i + 1] = min_sequence
+            out_seq_pos[i + 1] = current_sequence
+
+        else:
+
+            out_beat[i + 1] = next_beat[beat]
+            out_seq_len[i + 1] = min_sequence
+            out_seq_pos[i + 1] = current_sequence
+            beat = next_beat[beat]
+            beats_since_jump += 1
+
+    return out_beat, out_seq_len, out_seq_pos
+
+
+class PlayVector(object):
+
+    """ The play vector, stored as three parallel int32 arrays.
+
+    beat, seq_len and seq_pos hold one entry per item of the play vector. Indexing
+    still hands back the {'beat', 'seq_len', 'seq_pos'} dict for a single item, built
+    on demand, and slicing returns a PlayVector over views of the same arrays. That
+    keeps existing callers working without a million dicts sitting in memory.
+    """
+
+    def __init__(self, beat, seq_len, seq_pos):
+        self.beat = beat
+        self.seq_len = seq_len
+        self.seq_pos = seq_pos
+
+    def __len__(self):
+        return self.beat.shape[0]
+
+    def __getitem__(self, index):
+
+        if isinstance(index, slice):
+            return PlayVector(self.beat[index], self.seq_len[index], self.seq_pos[index])
+
+        return {'beat': int(self.beat[index]),
+                'seq_len': int(self.seq_len[index]),
+                'seq_pos': int(self.seq_pos[index])}
+
+    def __iter__(self):
+        for b, l, p in zip(self.beat.tolist(), self.seq_len.tolist(), self.seq_pos.tolist()):
+            yield {'beat': b, 'seq_len': l, 'seq_pos': p}
+
+
+# MiB of pairwise distances each silhouette score computation may hold at a time
+SILHOUETTE_WORKING_MEMORY = 256
+
+
+def _segment_stats_from_labels(labels):
+    """
+    Computes the segment/cluster ratio and whether any segment is a single beat
+    long (an orphan) given an array of labels.
+    """
+
+    labels = np.asarray(labels)
+
+    # the index of the first beat of every segment after the first one
+    boundaries = np.flatnonzero(labels[1:] != labels[:-1]) + 1
+
+    segment_count = boundaries.size + 1
+    clusters = labels.max() + 1
+
+    # lengths of every segment but the last (which is still open when the labels run out)
+    segment_lengths = np.diff(boundaries, prepend=0)
+
+    return float(segment_count) / float(clusters), bool((segment_lengths == 1).any())
+
+
+def _fit_and_score(n_clusters, X, D, random_state=0):
+    """
+    Clusters the beats into n_clusters groups and grades the result.
+
+    Module level so joblib can run one candidate cluster count per worker
+    for InfiniteJukebox.__compute_best_cluster_with_sil.
+
+    Args:
+        n_clusters: The candidate cluster count
+        X: The first n_clusters normalized Eigen-vectors, one row per beat
+        D: Pairwise distances between the beats, shared by every candidate
+        random_state: Seed for KMeans, fixed so results don't depend on scheduling
+
+    Returns:
+        (n_clusters, cluster_labels, cluster_score)
+    """
+
+    # create the candidate clusters and fit them. This is only a screening pass over
+    # the candidate counts, so a few randomly seeded runs are good enough to rank them;
+    # the winner is refit with k-means++ and more restarts afterwards.
+    clusterer = sklearn.cluster.KMeans(n_clusters=n_clusters, init='random', n_init=3,
+                                       max_iter=100, algorithm='lloyd', random_state=random_state)
+
+    cluster_labels = clusterer.fit_predict(X)
+
+    # silhouette_score works through the pairwise distances in blocks of at most
+    # working_memory MiB; keep that small since several of these run at once
+    with sklearn.config_context(working_memory=SILHOUETTE_WORKING_MEMORY):
+        silhouette_avg = sklearn.metrics.silhouette_score(D, cluster_labels, metric='precomputed')
+
+    return (n_clusters, cluster_labels, _grade_clusters(n_clusters, cluster_labels, silhouette_avg))
+
+
+def _fit_and_score_gpu(n_clusters, X, X_all, random_state=0):
+    """
+    GPU counterpart of _fit_and_score, built on cuML.
+
+    Args:
+        n_clusters: The candidate cluster count
+        X: The first n_clusters normalized Eigen-vectors, one row per beat, as a cupy array
+        X_all: The normalized Eigen-vectors the silhouette distances are measured in, as a cupy array
+        random_state: Seed for KMeans
+
+    Returns:
+        (n_clusters, cluster_labels, cluster_score), with cluster_labels back on the host
+    """
+
+    clusterer = cuml.cluster.KMeans(n_clusters=n_clusters, init='random', n_init=3,
+                                    max_iter=100, random_state=random_state)
+
+    labels_gpu = clusterer.fit_predict(X)
+
+    # cuML computes the silhouette in batches on the device, so the N x N distance
+    # matrix is never materialized
+    silhouette_avg = float(cuml.metrics.cluster.silhouette_score(X_all, labels_gpu))
+
+    cluster_labels = cupy.asnumpy(labels_gpu)
+
+    return (n_clusters, cluster_labels, _grade_clusters(n_clusters, cluster_labels, silhouette_avg))
+
+
+def _grade_clusters(n_clusters, cluster_labels, silhouette_avg):
+    """
+    Computes the fitness score of one candidate cluster count.
+
+    Args:
+        n_clusters: The candidate cluster count
+        cluster_labels: The cluster of each beat
+        silhouette_avg: The average silhouette score of cluster_labels
+
+    Returns:
+        The candidate's cluster_score; higher is better
+    """
+
+    # get the other key statistics: the ratio of segments to clusters, and whether
+    # any segment in this cluster configuration is only one beat long
+
+    ratio, has_orphan = _segment_stats_from_labels(cluster_labels)
+
+    # We need to grade each cluster according to how likely it is to produce a good
+    # result. There are a few factors to look at.
+    #
+    # First, we can look at how similar the beats in each cluster (on average) are for
+    # this candidate cluster size. This is known as the silhouette score. It ranges
+    # from -1 (very bad) to 1 (very good).
+    #
+    # Another thing we can look at is the ratio of clusters to segments. Higher ratios
+    # are preferred because they afford each beat in a cluster the opportunity to jump
+    # around to meaningful places in the song.
+    #
+    # All other things being equal, we prefer a higher cluster count to a lower one
+    # because it will tend to make the jumps more selective -- and therefore higher
+    # quality.
+    #
+    # Lastly, if we see that we have segments equal to just one beat, that might be
+    # a sign of overfitting. We call these one beat segments 'orphans'. Some songs,
+    # however, will have orphans no matter what cluster count you use. So, we don't
+    # want to throw out a cluster count just because it has orphans. Instead, we
+    # just de-rate its fitness score. If most of the cluster candidates have orphans
+    # then this won't matter in the overall scheme because everyone will be de-rated
+    # by the same scaler.
+    #
+    # Putting this all together, we muliply the cluster count * the average
+    # silhouette score for the clusters in this candidate * the ratio of clusters to
+    # segments. Then we scale (or de-rate) the fitness score by whether or not is has
+    # orphans in it.
+
+    orphan_scaler = .8 if has_orphan else 1
+
+    cluster_score = n_clusters * silhouette_avg * ratio * orphan_scaler
+    #cluster_score = ((n_clusters/48.0) * silhouette_avg * (ratio/10.0)) * orphan_scaler
+
+    return cluster_score
+
+
 class InfiniteJukebox(object):
 
     """ Class to "infinitely" remix a song.
@@ -115,7 +429,7 @@ class InfiniteJukebox(object):
                  seconds long. A song that is 120bpm will have a beat duration of .5 sec,
                  so this playlist will last .5 * 1024 * 1024 seconds -- or 145.67 hours.
 
-                 Each item contains:
+                 It is a PlayVector; indexing it gives a dict per item that contains:
 
                     beat: an index into the beats array of the beat to play
                  seq_len: the length of the musical sequence being played
@@ -125,6 +439,16 @@ class InfiniteJukebox(object):
 
     """
 
+    # the largest cluster counts tried by the silhouette and v1 auto-clustering searches
+    MAX_SIL_CLUSTERS = 48
+    MAX_V1_CLUSTERS = 62
+
+    # songs with at least this many beats whose affinity matrix is at most this dense
+    # (ignoring entries below SPARSE_AFFINITY_EPS) use the sparse eigensolver
+    SPARSE_EIGEN_MIN_BEATS = 1500
+    SPARSE_EIGEN_MAX_DENSITY = 0.1
+    SPARSE_AFFINITY_EPS = 1e-4
+
     def __init__(self, filename, start_beat=1, clusters=0, progress_callback=None,
                  do_async=False, use_v1=False, starting_beat_cache=None):
 
@@ -175,25 +499,13 @@ class InfiniteJukebox(object):
         Returns:
             numpy.ndarray: A symmetric version of the input matrix.
         """
-        # Get the dimensions of the input matrix
-        n_rows, n_cols = Rf.shape
-
         # Ensure the matrix is square
-        if n_rows != n_cols:
+        if Rf.shape[0] != Rf.shape[1]:
             raise ValueError("Input matrix must be square for symmetrization.")
 
-        # Create a new array to store the symmetric matrix
-        Rf_symmetric = np.zeros_like(Rf, dtype=Rf.dtype)
-
-        # Iterate through the upper triangle of the matrix (including the diagonal)
-        for i in range(n_rows):
-            for j in range(i, n_cols):
-                # Calculate the average of Rf[i, j] and Rf[j, i]
-                average_value = (Rf[i, j] + Rf[j, i]) / 2
-
-                # Set both Rf_symmetric[i, j] and Rf_symmetric[j, i] to the average
-                Rf_symmetric[i, j] = average_value
-                Rf_symmetric[j, i] = average_value
+        # Average the matrix with its transpose in two vectorized passes
+        Rf_symmetric = np.add(Rf, Rf.T, out=np.empty_like(Rf))
+        Rf_symmetric *= 0.5
 
         return Rf_symmetric
 
@@ -225,9 +537,11 @@ class InfiniteJukebox(object):
         self.sample_rate = sr
 
         # after the raw audio bytes are saved, convert the samples to mono
-        # because the beat detection algorithm in librosa requires it.
+        # because the beat detection algorithm in librosa requires it. Rebinding
+        # y releases the stereo samples as soon as the mix-down is done.
 
-        y = librosa.core.to_mono(y)
+        if y.ndim == 2:
+            y = np.mean(y, axis=0, dtype=np.float32)
 
         self.__report_progress( .2, "computing pitch data..." )
 
@@ -236,8 +550,22 @@ class InfiniteJukebox(object):
         BINS_PER_OCTAVE = 12 * 3
         N_OCTAVES = 7
 
-        cqt = librosa.cqt(y=y, sr=sr, bins_per_octave=BINS_PER_OCTAVE, n_bins=N_OCTAVES * BINS_PER_OCTAVE)
-        C = librosa.amplitude_to_db( np.abs(cqt), ref=np.max)
+        # The CQT, the log-power mel spectrogram (for the MFCCs) and the RMS envelope only
+        # depend on y, so compute them on worker threads while the beat finding below
+        # runs. librosa spends most of that time in numpy/FFT code that
+        # releases the GIL. Each result is collected where it is first needed.
+
+        feature_pool = concurrent.futures.ThreadPoolExecutor(max_workers=3)
+
+        cqt_future = feature_pool.submit(librosa.cqt, y=y, sr=sr, bins_per_octave=BINS_PER_OCTAVE,
+                                         n_bins=N_OCTAVES * BINS_PER_OCTAVE)
+        log_mel_future = feature_pool.submit(lambda: librosa.power_to_db(librosa.feature.melspectrogram(y=y, sr=sr)))
+
+        # newer versions of librosa have renamed the rmse function
+        rms_future = feature_pool.submit(librosa.feature.rms if hasattr(librosa.feature, 'rms') else librosa.feature.rmse,
+                                         y=y)
+
+        feature_pool.shutdown(wait=False)
 
         ##########################################################
         # To reduce dimensionality, we'll beat-synchronous the CQT
@@ -255,8 +583,13 @@ class InfiniteJukebox(object):
     
             self.__report_progress( .3, "Running a high precision beat finding algorithm. This could take up to 2 minutes..." )
     
-            proc = madmom.features.DBNDownBeatTrackingProcessor(beats_per_bar=[3, 4], fps=100)
-            act = madmom.features.RNNDownBeatProcessor()(y)
+            # both madmom processors can fan out over several threads. MADMOM_THREADS
+            # overrides the default of one per core.
+            madmom_threads = int(os.environ.get('MADMOM_THREADS', os.cpu_count() or 1))
+
+            proc = madmom.features.DBNDownBeatTrackingProcessor(beats_per_bar=[3, 4], fps=100,
+                                                                num_threads=madmom_threads)
+            act = self.__downbeat_activations(y, sr, madmom_threads)
             downbeats = proc(act)
 
             # write downbeat cache
@@ -278,11 +611,21 @@ class InfiniteJukebox(object):
 
         ### END MADMOM
 
+        C = librosa.amplitude_to_db( np.abs(cqt_future.result()), ref=np.max)
+
         # tempo, btz = librosa.beat.beat_track(y=y, sr=sr)
         Csync = librosa.util.sync(C, btz, aggregate=np.median)
 
+        # the beat times already pin down the tempo: every row of downbeats is a beat,
+        # so the median gap between them is the beat period. Only estimate it from the
+        # onset envelope if there are too few beats for that.
+
         # self.tempo = tempo[0]
-        self.tempo = librosa.feature.tempo(y=y, sr=sr)[0]
+        if len(downbeats) > 1:
+            self.tempo = float(60.0 / np.median(np.diff(downbeats[:, 0])))
+        else:
+            self.tempo = librosa.feature.tempo(onset_envelope=librosa.onset.onset_strength(S=log_mel_future.result(), sr=sr),
+                                               sr=sr)[0]
 
         # For alignment purposes, we'll need the timing of the beats
         # we fix_frames to include non-beat frames 0 and C.shape[1] (final frame)
@@ -314,60 +657,49 @@ class InfiniteJukebox(object):
         #
         # Here, we take :math:`\sigma` to be the median distance between successive beats.
         #
-        mfcc = librosa.feature.mfcc(y=y, sr=sr)
+        mfcc = librosa.feature.mfcc(S=log_mel_future.result(), sr=sr)
         Msync = librosa.util.sync(mfcc, btz)
 
         path_distance = np.sum(np.diff(Msync, axis=1)**2, axis=0)
         sigma = np.median(path_distance)
         path_sim = np.exp(-path_distance / sigma)
 
-        R_path = np.diag(path_sim, k=1) + np.diag(path_sim, k=-1)
+        # R_path = np.diag(path_sim, k=1) + np.diag(path_sim, k=-1) only has its first
+        # off-diagonals set, so work from path_sim rather than building it densely
 
+        path_idx = np.arange(len(path_sim))
 
         ##########################################################
         # And compute the balanced combination (Equations 6, 7, 9)
 
-        deg_path = np.sum(R_path, axis=1)
+        deg_path = np.zeros(len(path_sim) + 1, dtype=path_sim.dtype)
+        deg_path[:-1] += path_sim
+        deg_path[1:] += path_sim
         deg_rec = np.sum(Rf, axis=1)
 
         mu = deg_path.dot(deg_path + deg_rec) / np.sum((deg_path + deg_rec)**2)
 
-        A = mu * Rf + (1 - mu) * R_path
+        # A = mu * Rf + (1 - mu) * R_path, built in place over Rf
+        A = Rf
+        A *= mu
+        A[path_idx, path_idx + 1] += (1 - mu) * path_sim
+        A[path_idx + 1, path_idx] += (1 - mu) * path_sim
 
         print(f"Dimensions of combined matrix A: {A.shape}")
 
         #####################################################
-        # Now let's compute the normalized Laplacian (Eq. 10)
-        L_orig = scipy.sparse.csgraph.laplacian(A, normed=True)
-        # make sure L is contiguous
-        L = np.ascontiguousarray(L_orig)
+        # Now let's compute the normalized Laplacian (Eq. 10) and its spectral decomposition.
+        print("Calc eigenvectors for Hermitian Laplacian")
 
-        # ### HACK: ensure L is contiguous to avoid seg fault with eig()
-        # # Save matrix L to disk
-        # np.save('laplacian_matrix.npy', L_orig)
-        # # Load matrix L back from disk
-        # L = np.load('laplacian_matrix.npy')
-
-        # # Verify that the loaded matrix is the same as the original
-        # if np.array_equal(L, L_orig):
-        #     print("Matrix L successfully saved and loaded.")
-        # else:
-        #     print("Warning: Loaded matrix L does not match the original.")
-
-        # ### END Hack
-
-        print(f"Dimensions of matrix Laplacian: {L.shape}")
-
-        # to use eigh(), matrix should be symmetrix and hermitian
-        is_hermitian = np.allclose(L, L.T.conj())
-
-        # and its spectral decomposition
-        if is_hermitian:
-            print("Calc eigenvectors for Hermitian Laplacian")
-            _, evecs = scipy.linalg.eigh(L)
+        # clustering only ever looks at the first k eigenvectors, so only ask
+        # for as many as the largest k we are going to try
+        if self.clusters > 0:
+            n_evecs = self.clusters
         else:
-            raise ValueError("Matrix L is not Hermitian. Cannot compute eigenvectors using scipy.linalg.eigh.")
-            return
+            n_evecs = self.MAX_V1_CLUSTERS if self._use_v1 else self.MAX_SIL_CLUSTERS
+        n_evecs = min(n_evecs, A.shape[0])
+
+        evecs = self.__laplacian_eigenvectors(A, n_evecs)
 
         # We can clean this up further with a median filter.
         # This can help smooth over small discontinuities
@@ -399,41 +731,48 @@ class InfiniteJukebox(object):
 
             self.__report_progress( .51, "using %d clusters" % self.clusters )
 
-            X = evecs[:, :k] / Cnorm[:, k-1:k]
-            seg_ids = sklearn.cluster.KMeans(n_clusters=k, max_iter=1000,
-                                             random_state=0, n_init=1000).fit_predict(X)
+            X = self.__cluster_features(evecs, 1.0 / Cnorm, k)
+            seg_ids = sklearn.cluster.KMeans(n_clusters=k, init='k-means++', max_iter=300,
+                                             random_state=0, n_init=10, copy_x=False).fit_predict(X)
 
         # Get the amplitudes and beat-align them
         self.__report_progress( .6, "getting amplitudes" )
 
-        # newer versions of librosa have renamed the rmse function
-
-        if hasattr(librosa.feature,'rms'):
-            amplitudes = librosa.feature.rms(y=y)
-        else:
-            amplitudes = librosa.feature.rmse(y=y)
+        amplitudes = rms_future.result()
 
         ampSync = librosa.util.sync(amplitudes, btz)
 
-        # create a list of tuples that include the ordinal position, the start time of the beat,
-        # the cluster to which the beat belongs and the mean amplitude of the beat
+        # line up, per beat, the start time of the beat, the cluster to which the beat
+        # belongs and the mean amplitude of the beat
 
-        zbeat_tuples = zip(range(0,len(btz)), beat_times, seg_ids, ampSync[0].tolist())
-        beat_tuples =tuple(zbeat_tuples)
+        num_beats = min(len(btz), len(beat_times), len(seg_ids), ampSync.shape[1])
+
+        starts = np.asarray(beat_times[:num_beats], dtype=np.float64)
+        clusters = np.asarray(seg_ids[:num_beats]).tolist()
+        beat_amplitudes = ampSync[0, :num_beats].tolist()
 
         info = []
 
         bytes_per_second = int(round(len(self.raw_audio) / self.duration))
 
+        # work out every beat's duration and its span of raw_audio up front. A beat lasts
+        # until the next one starts; the last one runs to the end of the track.
+        durations = np.diff(np.append(starts, self.duration))
+
+        start_pos = starts * bytes_per_second
+        start_indices = np.where(start_pos % 2 > 1.5, np.ceil(start_pos), start_pos).astype(np.int64).tolist()
+        stop_indices = np.ceil((starts + durations) * bytes_per_second).astype(np.int64).tolist()
+        durations = durations.tolist()
+
         last_cluster = -1
         current_segment = -1
         segment_beat = 0
 
-        for i in range(0, len(beat_tuples)):
+        for i in range(0, num_beats):
             final_beat = {}
-            final_beat['start'] = float(beat_tuples[i][1])
-            final_beat['cluster'] = int(beat_tuples[i][2])
-            final_beat['amplitude'] = float(beat_tuples[i][3])
+            final_beat['start'] = float(starts[i])
+            final_beat['cluster'] = int(clusters[i])
+            final_beat['amplitude'] = float(beat_amplitudes[i])
 
             if final_beat['cluster'] != last_cluster:
                 current_segment += 1
@@ -446,17 +785,9 @@ class InfiniteJukebox(object):
 
             last_cluster = final_beat['cluster']
 
-            if i == len(beat_tuples) - 1:
-                final_beat['duration'] = self.duration - final_beat['start']
-            else:
-                final_beat['duration'] = beat_tuples[i+1][1] - beat_tuples[i][1]
-
-            if ( (final_beat['start'] * bytes_per_second) % 2 > 1.5 ):
-                final_beat['start_index'] = int(math.ceil(final_beat['start'] * bytes_per_second))
-            else:
-                final_beat['start_index'] = int(final_beat['start'] * bytes_per_second)
-
-            final_beat['stop_index'] = int(math.ceil((final_beat['start'] + final_beat['duration']) * bytes_per_second))
+            final_beat['duration'] = durations[i]
+            final_beat['start_index'] = start_indices[i]
+            final_beat['stop_index'] = stop_indices[i]
 
             # save pointers to the raw bytes for each beat with each beat.
             final_beat['buffer'] = self.raw_audio[ final_beat['start_index'] : final_beat['stop_index'] ]
@@ -467,7 +798,8 @@ class InfiniteJukebox(object):
 
         # get the max amplitude of the beats
         # max_amplitude = max([float(b['amplitude']) for b in info])
-        max_amplitude = sum([float(b['amplitude']) for b in info]) / len(info)
+        amps = np.fromiter((b['amplitude'] for b in info), dtype=np.float64, count=len(info))
+        max_amplitude = float(amps.mean())
 
         # assume that the fade point of the song is the last beat of the song that is >= 75% of
         # the max amplitude.
@@ -476,10 +808,10 @@ class InfiniteJukebox(object):
 
         fade = len(info) - 1
 
-        for b in reversed(info):
-            if b['amplitude'] >= (.75 * max_amplitude):
-                fade = info.index(b)
-                break
+        loud = np.flatnonzero(amps >= (.75 * max_amplitude))
+
+        if loud.size:
+            fade = int(loud[-1])
 
         # truncate the beats to [start:fade + 1]
         beats = info[self.__start_beat:fade + 1]
@@ -489,15 +821,25 @@ class InfiniteJukebox(object):
         self.__report_progress( .8, "computing final beat array..." )
 
         # assign final beat ids
-        for beat in beats:
-            beat['id'] = beats.index(beat)
-            beat['quartile'] = beat['id'] // (len(beats) / 4.0)
+        for idx, beat in enumerate(beats):
+            beat['id'] = idx
+            beat['quartile'] = idx // (len(beats) / 4.0)
+
+        # per-beat attributes as flat arrays so jump candidates can be found with
+        # boolean masks instead of rescanning the beat dicts for every beat.
+
+        cluster_np = np.fromiter((b['cluster'] for b in beats), dtype=np.int32, count=len(beats))
+        is_np = np.fromiter((b['is'] for b in beats), dtype=np.int32, count=len(beats))
+        segment_np = np.fromiter((b['segment'] for b in beats), dtype=np.int32, count=len(beats))
+        id_np = np.arange(len(beats), dtype=np.int32)
+        mod4_np = id_np & 3
+        loopable_np = id_np >= loop_bounds_begin
 
         # compute a coherent 'next' beat to play. This is always just the next ordinal beat
         # unless we're at the end of the song. Then it gets a little trickier.
 
         for beat in beats:
-            if beat == beats[-1]:
+            if beat['id'] == len(beats) - 1:
 
                 # if we're at the last beat, then we want to find a reasonable 'next' beat to play. It should (a) share the
                 # same cluster, (b) be in a logical place in its measure, (c) be after the computed loop_bounds_begin, and
@@ -511,27 +853,33 @@ class InfiniteJukebox(object):
             else:
                 beat['next'] = beat['id'] + 1
 
+        # the cluster, segment position and place in the measure of every beat's 'next' beat
+
+        next_np = np.fromiter((b['next'] for b in beats), dtype=np.int32, count=len(beats))
+        next_cluster_np = cluster_np[next_np]
+        next_is_np = is_np[next_np]
+        next_mod4_np = next_np & 3
+
+        for i, beat in enumerate(beats):
+
             # find all the beats that (a) are in the same cluster as the NEXT oridnal beat, (b) are of the same
             # cluster position as the next ordinal beat, (c) are in the same place in the measure as the NEXT beat,
             # (d) but AREN'T the next beat, and (e) AREN'T in the same cluster as the current beat.
             #
             # THAT collection of beats contains our jump candidates
 
-            jump_candidates = [bx['id'] for bx in beats[loop_bounds_begin:] if
-                               (bx['cluster'] == beats[beat['next']]['cluster']) and
-                               (bx['is'] == beats[beat['next']]['is']) and
-                               (bx['id'] % 4 == beats[beat['next']]['id'] % 4) and
-                               (bx['segment'] != beat['segment']) and
-                               (bx['id'] != beat['next'])]
+            mask = (loopable_np &
+                    (cluster_np == next_cluster_np[i]) &
+                    (is_np == next_is_np[i]) &
+                    (mod4_np == next_mod4_np[i]) &
+                    (segment_np != segment_np[i]) &
+                    (id_np != next_np[i]))
 
-            if jump_candidates:
-                beat['jump_candidates'] = jump_candidates
-            else:
-                beat['jump_candidates'] = []
+            beat['jump_candidates'] = np.flatnonzero(mask).tolist()
 
         # save off the segment count
 
-        self.segments = max([b['segment'] for b in beats]) + 1
+        self.segments = int(segment_np.max()) + 1
 
         # we don't want to ever play past the point where it's impossible to loop,
         # so let's find the latest point in the song where there are still jump
@@ -539,16 +887,16 @@ class InfiniteJukebox(object):
 
         last_chance = len(beats) - 1
 
-        for b in reversed(beats):
+        for ridx, b in enumerate(reversed(beats)):
             if len(b['jump_candidates']) > 0:
-                last_chance = beats.index(b)
+                last_chance = len(beats) - 1 - ridx
                 break
 
         # if we play our way to the last beat that has jump candidates, then just skip
         # to the earliest jump candidate rather than enter a section from which no
-        # jumping is possible.
+        # jumping is possible. (jump_candidates are in ascending order.)
 
-        beats[last_chance]['next'] = min(beats[last_chance]['jump_candidates'])
+        beats[last_chance]['next'] = beats[last_chance]['jump_candidates'][0]
 
         # store the beats that start after the last jumpable point. That's
         # the outro to the song. We can use these
@@ -580,15 +928,8 @@ class InfiniteJukebox(object):
 
         min_sequence = max(random.randrange(16, max_sequence_len, 4), loop_bounds_begin)
 
-        current_sequence = 0
-        beat = beats[0]
-
         self.__report_progress( .9, "creating play vector" )
 
-        play_vector = []
-
-        play_vector.append( {'beat':0, 'seq_len':min_sequence, 'seq_pos':current_sequence} )
-
         # we want to keep a list of recently played segments so we don't accidentally wind up in a local loop
         #
         # the number of segments in a song will vary so we want to set the number of recents to keep
@@ -600,8 +941,6 @@ class InfiniteJukebox(object):
         recent_depth = int(round(self.segments * .25))
         recent_depth = max( recent_depth, 1 )
 
-        recent = collections.deque(maxlen=recent_depth)
-
         # keep track of the time since the last successful jump. If we go more than
         # 10% of the song length since our last jump, then we will prioritize an
         # immediate jump to a not recently played segment. Otherwise playback will
@@ -609,129 +948,115 @@ class InfiniteJukebox(object):
         # local loops.
 
         max_beats_between_jumps = int(round(len(beats) * .1))
-        beats_since_jump = 0
-        failed_jumps = 0
-
-        for i in range(0, 1024 * 1024):
-
-            if beat['segment'] not in recent:
-                recent.append(beat['segment'])
-
-            current_sequence += 1
-
-            # it's time to attempt a jump if we've played all the beats we wanted in the
-            # current sequence. Also, if we've gone more than 10% of the length of the song
-            # without jumping we need to immediately prioritze jumping to a non-recent segment.
 
-            will_jump = (current_sequence == min_sequence) or (beats_since_jump >= max_beats_between_jumps)
+        # the play vector itself is built by _play_vector_kernel over flat arrays. It
+        # follows the rules above: jump to a random non-recent candidate when the
+        # current sequence is done (or we've gone too long without a jump), fall back
+        # to the furthest candidate in another quartile after failing for 10% of the
+        # song, and restart at loop_bounds_begin after failing for 20%.
 
-            # since it's time to jump, let's find the most musically pleasing place
-            # to go
+        quartile_np = np.fromiter((b['quartile'] for b in beats), dtype=np.int32, count=len(beats))
+        next_np = np.fromiter((b['next'] for b in beats), dtype=np.int32, count=len(beats))
 
-            if ( will_jump ):
+        jc_lengths = np.fromiter((len(b['jump_candidates']) for b in beats), dtype=np.int32, count=len(beats))
+        jc_offsets = np.zeros(len(beats) + 1, dtype=np.int32)
+        np.cumsum(jc_lengths, out=jc_offsets[1:])
+        jc_values = np.fromiter((c for b in beats for c in b['jump_candidates']), dtype=np.int32,
+                                count=int(jc_offsets[-1]))
 
-                # find the jump candidates that haven't been recently played
-                non_recent_candidates = [c for c in beat['jump_candidates'] if beats[c]['segment'] not in recent]
+        pv_beat, pv_seq_len, pv_seq_pos = _play_vector_kernel(segment_np, quartile_np, next_np,
+                                                              jc_values, jc_offsets,
+                                                              loop_bounds_begin, recent_depth, self.segments,
+                                                              min_sequence, max_sequence_len,
+                                                              max_beats_between_jumps, 1024 * 1024,
+                                                              random.randrange(2 ** 31))
 
-                # if there aren't any good jump candidates, then we need to fall back
-                # to another selection scheme.
+        play_vector = PlayVector(pv_beat, pv_seq_len, pv_seq_pos)
 
-                if len(non_recent_candidates) == 0:
+        # save off the beats array and play_vector. Signal
+        # the play_ready event (if it's been set)
 
-                    beats_since_jump += 1
-                    failed_jumps += 1
+        self.beats = beats
+        self.play_vector = play_vector
 
-                    # suppose we've been trying to jump but couldn't find a good non-recent candidate. If
-                    # the length of time we've been trying (and failing) is >= 10% of the song length
-                    # then it's time to relax our criteria. Let's find the jump candidate that's furthest
-                    # from the current beat (irrespective if it's been played recently) and go there. Ideally
-                    # we'd like to jump to a beat that is not in the same quartile of the song as the currently
-                    # playing section. That way we maximize our chances of avoiding a long local loop -- such as
-                    # might be found in the section preceeding the outro of a song.
+        self.__report_progress(1.0, "finished processing")
 
-                    non_quartile_candidates = [c for c in beat['jump_candidates'] if beats[c]['quartile'] != beat['quartile']]
+        if self.play_ready:
+            self.play_ready.set()
 
-                    if (failed_jumps >= (.1 * len(beats))) and (len(non_quartile_candidates) > 0):
+    def __report_progress(self, pct_done, message):
 
-                        furthest_distance = max([abs(beat['id'] - c) for c in non_quartile_candidates])
+        """ If a reporting callback was passed, call it in order
+            to mark progress.
+        """
+        if self.__progress_callback:
+            self.__progress_callback( pct_done, message )
 
-                        jump_to = next(c for c in non_quartile_candidates
-                                       if abs(beat['id'] - c) == furthest_distance)
+    def __downbeat_activations(self, y, sr, num_threads):
 
-                        beat = beats[jump_to]
-                        beats_since_jump = 0
-                        failed_jumps = 0
+        """ Returns madmom's RNN downbeat activations for the mono samples y.
 
-                    # uh oh! That fallback hasn't worked for yet ANOTHER 10%
-                    # of the song length. Something is seriously broken. Time
-                    # to punt and just start again from the first beat.
+            The RNN is by far the slowest part of beat finding, so its output is
+            cached next to the audio file. Only the cheap DBN decoding has to run
+            again when the downbeat cache is missing. The cache is tied to the
+            sample rate and length of y so a re-trimmed file recomputes it.
+        """
 
-                    elif failed_jumps >= (.2 * len(beats)):
-                        beats_since_jump = 0
-                        failed_jumps = 0
-                        beat = beats[loop_bounds_begin]
+        act_cache_filename = self.__filename + '.act.npz'
 
-                    # asuuming we're not in one of the failure modes but haven't found a good
-                    # candidate that hasn't been recently played, just play the next beat in the
-                    # sequence
+        try:
+            with np.load(act_cache_filename, allow_pickle=False) as cached:
+                if cached['sr'] == sr and cached['num_samples'] == len(y):
+                    return cached['act']
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"Warning: Failed to read activation cache {act_cache_filename}. Error: {e}")
 
-                    else:
-                        beat = beats[beat['next']]
+        act = madmom.features.RNNDownBeatProcessor(num_threads=num_threads)(y).astype(np.float32)
 
-                else:
+        try:
+            np.savez(act_cache_filename, act=act, sr=sr, num_samples=len(y))
+        except Exception as e:
+            print(f"Warning: Failed to write activation cache to {act_cache_filename}. Error: {e}")
 
-                    # if it's time to jump and we have at least one good non-recent
-                    # candidate, let's just pick randomly from the list and go there
+        return act
 
-                    beats_since_jump = 0
-                    failed_jumps = 0
-                    beat = beats[ random.choice(non_recent_candidates) ]
+    def __laplacian_eigenvectors(self, A, n_evecs):
 
-                # reset our sequence position counter and pick a new target length
-                # between 16 and max_sequence_len, making sure it's evenly divisible by
-                # 4 beats
+        """ Returns the n_evecs eigenvectors of the normalized Laplacian of A with the
+            smallest eigenvalues, in ascending order of eigenvalue.
 
-                current_sequence = 0
-                min_sequence = random.randrange(16, max_sequence_len, 4)
+            L is symmetric by construction (A is symmetric and the normalized Laplacian
+            preserves that). Most songs go to a dense eigh(), which reads only the lower
+            triangle and itself rejects NaN/inf entries. For long songs, where that gets
+            expensive and A is mostly (near) zeros, the eigenvectors come from Lanczos
+            iteration on a sparse matrix instead.
+        """
 
-                # if we're in the place where we want to jump but can't because
-                # we haven't found any good candidates, then set current_sequence equal to
-                # min_sequence. During playback this will show up as having 00 beats remaining
-                # until we next jump. That's the signal that we'll jump as soon as we possibly can.
-                #
-                # Code that reads play_vector and sees this value can choose to visualize this in some
-                # interesting way.
+        N = A.shape[0]
 
-                if beats_since_jump >= max_beats_between_jumps:
-                    current_sequence = min_sequence
+        if N >= self.SPARSE_EIGEN_MIN_BEATS:
 
-                # add an entry to the play_vector
-                play_vector.append({'beat':beat['id'], 'seq_len': min_sequence, 'seq_pos': current_sequence})
-            else:
+            keep = A >= self.SPARSE_AFFINITY_EPS
 
-                # if we're not trying to jump then just add the next item to the play_vector
-                play_vector.append({'beat':beat['next'], 'seq_len': min_sequence, 'seq_pos': current_sequence})
-                beat = beats[beat['next']]
-                beats_since_jump += 1
+            if np.count_nonzero(keep) <= self.SPARSE_EIGEN_MAX_DENSITY * N * N:
 
-        # save off the beats array and play_vector. Signal
-        # the play_ready event (if it's been set)
+                L = scipy.sparse.csgraph.laplacian(scipy.sparse.csr_matrix(np.where(keep, A, 0)), normed=True)
 
-        self.beats = beats
-        self.play_vector = play_vector
+                # the smallest eigenvalues of L are the largest of I - L, which Lanczos
+                # converges on without having to factorize the (singular) Laplacian
+                M = scipy.sparse.identity(N, dtype=L.dtype, format='csr') - L
+                _, evecs = scipy.sparse.linalg.eigsh(M, k=n_evecs, which='LA', tol=1e-4)
 
-        self.__report_progress(1.0, "finished processing")
+                return evecs[:, ::-1]
 
-        if self.play_ready:
-            self.play_ready.set()
+        # make sure L is contiguous
+        L = np.ascontiguousarray(scipy.sparse.csgraph.laplacian(A, normed=True))
 
-    def __report_progress(self, pct_done, message):
+        _, evecs = scipy.linalg.eigh(L, lower=True, subset_by_index=[0, n_evecs - 1], driver='evr')
 
-        """ If a reporting callback was passed, call it in order
-            to mark progress.
-        """
-        if self.__progress_callback:
-            self.__progress_callback( pct_done, message )
+        return evecs
 
     def __compute_best_cluster_with_sil(self, evecs, Cnorm):
 
@@ -787,6 +1112,11 @@ class InfiniteJukebox(object):
 
         self._clusters_list = []
 
+        # KMeans and the distance computations keep float32 input as float32, which halves
+        # the memory traffic of their inner loops. Single precision is plenty for these.
+        evecs = np.ascontiguousarray(evecs, dtype=np.float32)
+        Cnorm = np.ascontiguousarray(Cnorm, dtype=np.float32)
+
         best_cluster_size = 0
         best_labels = None
         best_cluster_score = 0
@@ -794,59 +1124,52 @@ class InfiniteJukebox(object):
         # we need at least 3 clusters for any song and shouldn't need to calculate more than
         # 48 clusters for even a really complicated peice of music.
 
-        for n_clusters in range(48, 2, -1):
+        self.__report_progress(.51, "Testing cluster values from %d to 3..." % self.MAX_SIL_CLUSTERS)
 
-            self.__report_progress(.51, "Testing a cluster value of %d..." % n_clusters)
+        inv_Cnorm = np.reciprocal(Cnorm, dtype=np.float32)
 
-            # compute a matrix of the Eigen-vectors / their normalized values
-            X = evecs[:, :n_clusters] / Cnorm[:, n_clusters-1:n_clusters]
+        # The silhouette scores only need distances between beats. Measure those once, in
+        # the space of all the normalized Eigen-vectors any candidate uses, and score every
+        # candidate's labels against the same distances rather than recomputing them per k.
 
-            # create the candidate clusters and fit them
-            clusterer = sklearn.cluster.KMeans(n_clusters=n_clusters, max_iter=300,
-                                               random_state=0, n_init=20)
+        X_all = self.__cluster_features(evecs, inv_Cnorm, min(self.MAX_SIL_CLUSTERS, evecs.shape[1]))
 
-            cluster_labels = clusterer.fit_predict(X)
+        # CLUSTER_GPU=1 runs the whole sweep on the GPU with cuML instead. The Eigen-vectors
+        # are uploaded once and only each candidate's labels come back to the host.
 
-            # get some key statistics, including how well each beat in the cluster resemble
-            # each other (the silhouette average), the ratio of segments to clusters, and the
-            # length of the smallest segment in this cluster configuration
+        if os.environ.get('CLUSTER_GPU', '0') == '1':
 
-            silhouette_avg = sklearn.metrics.silhouette_score(X, cluster_labels)
+            if cuml is None:
+                raise ImportError('CLUSTER_GPU=1 requires the cuml and cupy packages')
 
-            ratio, min_segment_len = self.__segment_stats_from_labels(cluster_labels.tolist())
+            evecs_gpu = cupy.asarray(evecs)
+            inv_Cnorm_gpu = cupy.asarray(inv_Cnorm)
+            X_all_gpu = cupy.asarray(X_all)
 
-            # We need to grade each cluster according to how likely it is to produce a good
-            # result. There are a few factors to look at.
-            #
-            # First, we can look at how similar the beats in each cluster (on average) are for
-            # this candidate cluster size. This is known as the silhouette score. It ranges
-            # from -1 (very bad) to 1 (very good).
-            #
-            # Another thing we can look at is the ratio of clusters to segments. Higher ratios
-            # are preferred because they afford each beat in a cluster the opportunity to jump
-            # around to meaningful places in the song.
-            #
-            # All other things being equal, we prefer a higher cluster count to a lower one
-            # because it will tend to make the jumps more selective -- and therefore higher
-            # quality.
-            #
-            # Lastly, if we see that we have segments equal to just one beat, that might be
-            # a sign of overfitting. We call these one beat segments 'orphans'. Some songs,
-            # however, will have orphans no matter what cluster count you use. So, we don't
-            # want to throw out a cluster count just because it has orphans. Instead, we
-            # just de-rate its fitness score. If most of the cluster candidates have orphans
-            # then this won't matter in the overall scheme because everyone will be de-rated
-            # by the same scaler.
+            results = [_fit_and_score_gpu(n_clusters, evecs_gpu[:, :n_clusters] * inv_Cnorm_gpu[:, n_clusters-1:n_clusters],
+                                          X_all_gpu)
+                       for n_clusters in range(self.MAX_SIL_CLUSTERS, 2, -1)]
+
+        else:
+
+            D = sklearn.metrics.pairwise_distances(X_all)
+
+            # every candidate cluster count is fitted and scored independently, so spread them
+            # over joblib workers. CLUSTER_JOBS caps the number of workers (default: one per core).
+            # The workers already split the cores between them, so keep each one's BLAS/OpenMP
+            # pools to a single thread rather than letting every worker start one per core.
+            # The refit below runs back in this process with its normal thread pools.
             #
-            # Putting this all together, we muliply the cluster count * the average
-            # silhouette score for the clusters in this candidate * the ratio of clusters to
-            # segments. Then we scale (or de-rate) the fitness score by whether or not is has
-            # orphans in it.
+            # D is N x N, so rather than pickling it into every task, joblib dumps any argument
+            # over max_nbytes to a memory-mapped file once and every worker maps it read-only.
 
-            orphan_scaler = .8 if min_segment_len == 1 else 1
+            with joblib.parallel_backend('loky', inner_max_num_threads=1):
+                results = joblib.Parallel(n_jobs=int(os.environ.get('CLUSTER_JOBS', -1)),
+                                          max_nbytes='1M', mmap_mode='r')(
+                    joblib.delayed(_fit_and_score)(n_clusters, self.__cluster_features(evecs, inv_Cnorm, n_clusters), D)
+                    for n_clusters in range(self.MAX_SIL_CLUSTERS, 2, -1))
 
-            cluster_score = n_clusters * silhouette_avg * ratio * orphan_scaler
-            #cluster_score = ((n_clusters/48.0) * silhouette_avg * (ratio/10.0)) * orphan_scaler
+        for n_clusters, cluster_labels, cluster_score in results:
 
             # if this cluster count has a score that's better than the best score so far, store
             # it for later.
@@ -856,52 +1179,47 @@ class InfiniteJukebox(object):
                 best_cluster_size = n_clusters
                 best_labels = cluster_labels
 
+        # the screening labels came from a quick randomly seeded fit; recompute the
+        # winner's clusters with k-means++ and more restarts
+        if best_cluster_size > 0:
+            X = self.__cluster_features(evecs, inv_Cnorm, best_cluster_size)
+            best_labels = sklearn.cluster.KMeans(n_clusters=best_cluster_size, max_iter=300,
+                                                 random_state=0, n_init=20, copy_x=False).fit_predict(X)
+
         # return the best results
         return (best_cluster_size, best_labels)
 
     @staticmethod
-    def __segment_count_from_labels(labels):
+    def __cluster_features(evecs, inv_Cnorm, k, out=None):
 
-        ''' Computes the number of unique segments from a set of ordered labels. Segements are
-            contiguous beats that belong to the same cluster. '''
-
-        segment_count = 0
-        previous_label = -1
+        ''' Returns the first k Eigen-vectors normalized by Cnorm as a C-contiguous float32
+            matrix, which KMeans can consume without making its own copy. Cnorm is passed
+            in as its reciprocal so callers trying many values of k only divide once.
 
-        for label in labels:
-            if label != previous_label:
-                previous_label = label
-                segment_count += 1
+            If out is given -- a flat float32 buffer with room for the whole matrix -- the
+            matrix is written into the front of it and returned as a view, so a caller
+            going through many values of k can reuse one allocation. (A column slice of
+            a 2-D buffer wouldn't do: it isn't contiguous, so KMeans would copy it.) '''
 
-        return segment_count
+        if out is None:
+            return np.multiply(evecs[:, :k], inv_Cnorm[:, k-1:k], dtype=np.float32)
 
-    def __segment_stats_from_labels(self, labels):
-        ''' Computes the segment/cluster ratio and min segment size value given an array
-            of labels. '''
+        features = evecs[:, :k]
 
-        segment_count = 0.0
-        segment_length = 0
-        clusters = max(labels) + 1
+        return np.multiply(features, inv_Cnorm[:, k-1:k], out=out[:features.size].reshape(features.shape))
 
-        previous_label = -1
-
-        segment_lengths = []
-
-        for label in labels:
-            if label != previous_label:
-                previous_label = label
-                segment_count += 1.0
+    @staticmethod
+    def __segment_count_from_labels(labels):
 
-                if segment_length > 0:
-                    segment_lengths.append(segment_length)
+        ''' Computes the number of unique segments from a set of ordered labels. Segements are
+            contiguous beats that belong to the same cluster. '''
 
-                segment_length = 1
-            else:
-                segment_length +=1
+        labels = np.asarray(labels)
 
-        # self.__report_progress( .52, "clusters: %d,  ratio: %f,  min_seg: %d" % (clusters, segment_count/len(labels), segment_length) )
+        if labels.size == 0:
+            return 0
 
-        return float(segment_count) / float(clusters), min(segment_lengths)
+        return int(np.count_nonzero(labels[1:] != labels[:-1])) + 1
 
     def __compute_best_cluster(self, evecs, Cnorm):
 
@@ -941,44 +1259,42 @@ class InfiniteJukebox(object):
 
         self._clusters_list = []
 
+        # KMeans and the distance computations keep float32 input as float32, which halves
+        # the memory traffic of their inner loops. Single precision is plenty for these.
+        evecs = np.ascontiguousarray(evecs, dtype=np.float32)
+        Cnorm = np.ascontiguousarray(Cnorm, dtype=np.float32)
+
+        inv_Cnorm = np.reciprocal(Cnorm, dtype=np.float32)
+
         # We compute the clusters between 4 and 64. Owing to the inherent
         # symmetry of Western popular music (including Jazz and Classical), the most
         # pleasing musical results will often, though not always, come from even cluster values.
 
-        for ki in range(4,64, 2):
+        # every candidate's features are written into the same buffer, sized for the largest
+        X_buf = np.empty(evecs.shape[0] * min(self.MAX_V1_CLUSTERS, evecs.shape[1]), dtype=np.float32)
+
+        for ki in range(4, self.MAX_V1_CLUSTERS + 1, 2):
 
             # compute a matrix of the Eigen-vectors / their normalized values
-            X = evecs[:, :ki] / Cnorm[:, ki-1:ki]
+            X = self.__cluster_features(evecs, inv_Cnorm, ki, out=X_buf)
 
             # cluster with candidate ki
             labels = sklearn.cluster.KMeans(n_clusters=ki, max_iter=1000,
-                                            random_state=0, n_init=20).fit_predict(X)
+                                            random_state=0, n_init=20, copy_x=False).fit_predict(X)
 
             entry = {'clusters':ki, 'labels':labels}
 
-            # create an array of dictionary entries containing (a) the cluster label,
-            # (b) the number of total beats that belong to that cluster, and
-            # (c) the number of segments in which that cluster appears.
+            # count (a) the number of total beats that belong to each cluster, and
+            # (b) the number of segments in which each cluster appears. A segment
+            # starts at the first beat and wherever the label changes.
 
-            lst = []
+            seg_starts = np.concatenate(([True], labels[1:] != labels[:-1]))
 
-            for i in range(0,ki):
-                lst.append( {'label':i, 'beats':0, 'segs':0} )
-
-            last_label = -1
-
-            for l in labels:
-
-                if l != last_label:
-                    lst[l]['segs'] += 1
-                    last_label = l
-
-                lst[l]['beats'] += 1
-
-            entry['cluster_map'] = lst
+            entry['beats_per_label'] = np.bincount(labels, minlength=ki)
+            entry['segs_per_label'] = np.bincount(labels[seg_starts], minlength=ki)
 
             # get the average number of segments to which a cluster belongs
-            entry['seg_ratio'] = np.mean([l['segs'] for l in entry['cluster_map']])
+            entry['seg_ratio'] = entry['segs_per_label'].mean()
 
             self._clusters_list.append(entry)
 
@@ -990,12 +1306,9 @@ class InfiniteJukebox(object):
 
         final_cluster_size = max(cl['clusters'] for cl in self._clusters_list if cl['seg_ratio'] >= max_seg_ratio)
 
-        # compute a very high fidelity set of clusters using our selected cluster size.
-        X = evecs[:, :final_cluster_size] / Cnorm[:, final_cluster_size-1:final_cluster_size]
-        labels = sklearn.cluster.KMeans(n_clusters=final_cluster_size, max_iter=1000,
-                                        random_state=0, n_init=1000).fit_predict(X)
-
-        # labels = next(c['labels'] for c in self._clusters_list if c['clusters'] == final_cluster_size)
+        # the sweep already fit this cluster size with 20 k-means++ restarts on the same
+        # features, so its labels are as good as a refit would give. Reuse them.
+        labels = next(c['labels'] for c in self._clusters_list if c['clusters'] == final_cluster_size)
 
         # return a tuple of (winning cluster size, [array of cluster labels for the beats])
         return (final_cluster_size, labels)